@@ -1,11 +1,16 @@
 from pathlib import Path
-from sklearn.decomposition import PCA
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from threading import BoundedSemaphore, Lock
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
-from sklearn.cluster import KMeans, DBSCAN
+from sklearn.cluster import KMeans, MiniBatchKMeans, DBSCAN
 from sklearn.preprocessing import StandardScaler, RobustScaler, PowerTransformer, Normalizer, FunctionTransformer
 from sklearn.pipeline import make_pipeline
-from sklearn.metrics import silhouette_samples
+from sklearn.metrics import pairwise_distances, pairwise_distances_argmin_min
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn
 import numpy as np
 import pandas as pd
@@ -14,6 +19,8 @@ import utils as utils
 import feature_utils as cu
 import utils as utils
 import os
+import pickle
+import copy
 
 
 def df_np_df(func):
@@ -26,6 +33,380 @@ def df_np_df(func):
     return convert_call_reconvert_df
 
 
+class ArtifactWriter:
+    """
+    Runs artifact writes (csv/meta saves, png files) on a background thread pool so the workflow can keep computing.
+    At most max_pending writes are queued or running at once; submit blocks past that, which bounds the memory held
+    by queued dataframes and figures. Errors are collected and raised by wait().
+    """
+    def __init__(self, max_workers=2, max_pending=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = BoundedSemaphore(max_pending)
+        self._lock = Lock()
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs). Callers must not mutate the args afterwards (pass copies of lists that keep growing).
+
+        :return: concurrent.futures.Future
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def savefig(self, fig, savepath):
+        # matplotlib isn't thread safe, so the figure is rendered here and only the file write is queued
+        buffer = BytesIO()
+        fig.savefig(buffer, format='png')
+        plt.close(fig)
+        return self.submit(utils.write_bytes, buffer.getvalue(), savepath)
+
+    def wait(self):
+        """
+        Blocks until every queued write has finished.
+        Raises the first write error (after printing the rest) if any failed.
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        errors = [e for e in (f.exception() for f in futures) if e is not None]
+        for e in errors[1:]:
+            print(f'Artifact write failed: {e!r}')
+        if errors:
+            raise RuntimeError(f'{len(errors)} of {len(futures)} artifact writes failed') from errors[0]
+
+    def close(self, raise_errors=True):
+        try:
+            if raise_errors:
+                self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+def save_figure(fig, savepath, writer=None):
+    """
+    Renders, saves and closes fig. With an ArtifactWriter only the file write happens in the background.
+    """
+    if writer is not None:
+        writer.savefig(fig, savepath)
+    else:
+        fig.savefig(savepath)
+        plt.close(fig)
+
+
+SCALERS = {'standard': StandardScaler, 'robust': RobustScaler}
+PCA_MODES = ['exact', 'randomized', 'incremental']
+PCA_CHUNK_ROWS = 20000
+
+
+def make_scaler(scaling_method):
+    """
+    :param scaling_method: "Standard" or "Robust", in any case
+    :return: an unfitted scikitlearn scaler
+    """
+    try:
+        return SCALERS[scaling_method.lower()]()
+    except KeyError:
+        raise ValueError(f'Unknown scaling method {scaling_method!r}, expected one of {list(SCALERS)}') from None
+
+
+def truncate_pca(pca, n_components):
+    """
+    :param pca: fitted scikitlearn PCA
+    :return: a PCA equivalent to fitting the same data with n_components (ie. pca's first n_components components)
+    """
+    truncated = copy.copy(pca)
+    truncated.n_components = truncated.n_components_ = n_components
+    for attr in ['components_', 'explained_variance_', 'explained_variance_ratio_', 'singular_values_']:
+        setattr(truncated, attr, getattr(pca, attr)[:n_components])
+    remaining_variance = pca.explained_variance_[n_components:]
+    truncated.noise_variance_ = remaining_variance.mean() if len(remaining_variance) else 0.
+    return truncated
+
+
+CLUSTER_ABBREVS = {'KMeans': 'k', 'MiniBatchKMeans': 'mbk'}
+
+
+def warm_start_centers(nparray, centers, cluster_count, seed=0):
+    """
+    Extends centers fit for a smaller k to cluster_count centers. Each new center is a point sampled with probability
+    proportional to its squared distance from the current centers (the k-means++ rule), which unlike the farthest
+    point isn't drawn to outliers.
+
+    :return: cluster_count x d array of initial centers
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.array(centers)
+    while len(centers) < cluster_count:
+        _, distances = pairwise_distances_argmin_min(nparray, centers)
+        weights = distances ** 2
+        new_center = rng.choice(len(nparray), p=weights / weights.sum()) if weights.sum() > 0 else rng.integers(len(nparray))
+        centers = np.vstack([centers, nparray[new_center]])
+    return centers
+
+
+def fit_clusterer(nparray, cluster_count, clustering_method, init_centers=None):
+    """
+    :param init_centers: optional centers of a fit with fewer clusters to warm start (KMeans methods only)
+    :return: (fitted clusterer or None if clustering_method is unknown, labels, meta)
+    """
+    meta = []
+    if clustering_method == "KMeans":
+        clusterer = KMeans(n_clusters=cluster_count)
+        # For future, include calculated distances.
+        # In the future, this will let us find centers:
+        # distances = clusterer.transform(nparray)
+        # nparray = np.concatenate((distances, labels))
+    elif clustering_method == "MiniBatchKMeans":
+        clusterer = MiniBatchKMeans(n_clusters=cluster_count, batch_size=4096)
+    # elif clustering_method == "FuzzyCMeans":
+    #     pass
+    elif clustering_method == "DBSCAN":
+        clusterer = DBSCAN(eps=0.3, min_samples=10)
+    else:
+        return None, [], meta
+    clusterer_str = str(clusterer)
+    if init_centers is not None and clustering_method in CLUSTER_ABBREVS:
+        clusterer.set_params(init=warm_start_centers(nparray, init_centers, cluster_count), n_init=1)
+        clusterer_str += f' warm started from k={len(init_centers)} centers'
+    labels = clusterer.fit_predict(nparray)
+    meta.append(f'Labels calculated via clusterer: {clusterer_str}')
+    return clusterer, labels, meta
+
+
+def _fit_clusterer_for_count(nparray, clustering_method, cluster_count):
+    return fit_clusterer(nparray, cluster_count, clustering_method)
+
+
+SILHOUETTE_MODES = ['exact', 'sampled', 'simplified']
+SILHOUETTE_SAMPLE_SIZE = 10000
+SILHOUETTE_CHUNK_BYTES = 2 ** 26
+
+
+def silhouette_of_points(nparray, labels, point_idx):
+    """
+    Exact silhouette values of the points at point_idx against all of nparray, computing the distances a chunk of
+    points at a time so memory stays at SILHOUETTE_CHUNK_BYTES instead of n x n.
+
+    :return: array of silhouette values, one per point_idx
+    """
+    clusters, inverse = np.unique(labels, return_inverse=True)
+    counts = np.bincount(inverse)
+    onehot = np.zeros((len(nparray), len(clusters)))
+    onehot[np.arange(len(nparray)), inverse] = 1
+    chunk_rows = max(1, SILHOUETTE_CHUNK_BYTES // (8 * len(nparray)))
+    dist_sums = np.empty((len(point_idx), len(clusters)))
+    for start in range(0, len(point_idx), chunk_rows):
+        chunk = point_idx[start:start + chunk_rows]
+        dist_sums[start:start + chunk_rows] = pairwise_distances(nparray[chunk], nparray) @ onehot
+    own = inverse[point_idx]
+    rows = np.arange(len(point_idx))
+    # mean distance to the rest of the point's own cluster (its distance to itself is 0)
+    intra = dist_sums[rows, own] / np.maximum(counts[own] - 1, 1)
+    mean_dists = dist_sums / counts
+    mean_dists[rows, own] = np.inf
+    nearest_other = mean_dists.min(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = (nearest_other - intra) / np.maximum(intra, nearest_other)
+    # scikitlearn's convention: 0 for points alone in their cluster
+    return np.nan_to_num(np.where(counts[own] > 1, values, 0))
+
+
+def simplified_silhouette(nparray, labels):
+    """
+    Centroid based silhouette: distance to the point's own cluster centroid against the distance to the nearest other
+    centroid. O(n * clusters), but only approximates the exact silhouette (well for compact, convex clusters).
+    """
+    clusters, inverse = np.unique(labels, return_inverse=True)
+    centroids = np.array([nparray[inverse == c].mean(axis=0) for c in range(len(clusters))])
+    dists = pairwise_distances(nparray, centroids)
+    rows = np.arange(len(nparray))
+    own = dists[rows, inverse]
+    dists[rows, inverse] = np.inf
+    nearest_other = dists.min(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = (nearest_other - own) / np.maximum(own, nearest_other)
+    return np.nan_to_num(values)
+
+
+def silhouette_values(nparray, labels, mode='exact', sample_size=SILHOUETTE_SAMPLE_SIZE, seed=0):
+    """
+    :param mode: 'exact' (every session, chunked), 'sampled' (exact values for a per-cluster stratified sample of
+    about sample_size sessions) or 'simplified' (simplified_silhouette of every session)
+    :return: (silhouette values, labels of those values, average silhouette, 95% confidence half width of the average
+    in sampled mode, otherwise None)
+    """
+    labels = np.asarray(labels)
+    if mode == 'exact':
+        values = silhouette_of_points(nparray, labels, np.arange(len(nparray)))
+        return values, labels, values.mean(), None
+    if mode == 'simplified':
+        values = simplified_silhouette(nparray, labels)
+        return values, labels, values.mean(), None
+    if mode != 'sampled':
+        raise ValueError(f'Unknown silhouette mode {mode!r}, expected one of {SILHOUETTE_MODES}')
+    rng = np.random.default_rng(seed)
+    fraction = min(1., sample_size / len(labels))
+    strata = [np.flatnonzero(labels == c) for c in np.unique(labels)]
+    sample_idx = [rng.choice(idx, size=min(len(idx), max(2, round(fraction * len(idx)))), replace=False)
+                  for idx in strata]
+    values = silhouette_of_points(nparray, labels, np.concatenate(sample_idx))
+    # stratified estimate of the mean and its standard error
+    avg_score, variance = 0., 0.
+    start = 0
+    for idx, sampled in zip(strata, sample_idx):
+        stratum_vals = values[start:start + len(sampled)]
+        start += len(sampled)
+        weight = len(idx) / len(labels)
+        avg_score += weight * stratum_vals.mean()
+        if len(sampled) > 1:
+            variance += weight ** 2 * stratum_vals.var(ddof=1) / len(sampled) * (1 - len(sampled) / len(idx))
+    return values, labels[np.concatenate(sample_idx)], avg_score, 1.96 * np.sqrt(variance)
+
+
+SCATTER_MAX_POINTS = 10000
+
+
+def decimate_indices(labels, max_points, seed=0):
+    """
+    :return: sorted positions of a per-label stratified sample of about max_points rows (all rows if there are fewer),
+    keeping each label's share and at least one row of every label
+    """
+    labels = np.asarray(labels)
+    if len(labels) <= max_points:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    fraction = max_points / len(labels)
+    strata = [np.flatnonzero(labels == c) for c in np.unique(labels)]
+    return np.sort(np.concatenate([rng.choice(idx, size=max(1, round(fraction * len(idx))), replace=False)
+                                   for idx in strata]))
+
+
+def draw_scatter_matrix(axs, df, labels, color_dict, max_points=SCATTER_MAX_POINTS):
+    """
+    Draws the Workflow.scatter grid onto axs: every pair of columns scattered (decimated to max_points, markers
+    rasterized so vector outputs stay small), with stacked per-label histograms of each column on the diagonal.
+    """
+    labels = np.asarray(labels)
+    nparray = df.to_numpy()
+    clusters = np.unique(labels)
+    keep = decimate_indices(labels, max_points)
+    # largest label drawn first, so the smaller ones stay visible on top of it
+    keep_by_cluster = sorted(((c, keep[labels[keep] == c]) for c in clusters), key=lambda ci: -len(ci[1]))
+    num_cols = len(df.columns)
+    for x in range(num_cols):
+        for y in range(num_cols):
+            ax = axs[x, y]
+            if x == y:
+                ax.hist([nparray[labels == c, x] for c in clusters], bins=30, stacked=True,
+                        color=[color_dict[c] for c in clusters])
+            else:
+                # one marker line per label rather than a scatter collection: Agg stamps identical markers much faster
+                for c, idx in keep_by_cluster:
+                    ax.plot(nparray[idx, x], nparray[idx, y], 'o', markersize=6, color=color_dict[c], rasterized=True)
+            ax.set_xlabel(df.columns[x])
+            ax.set_ylabel(df.columns[y])
+
+
+class ScatterMatrix:
+    """
+    Keeps one figure per grid size for Workflow.scatter to redraw, rather than building a new 30x30 inch figure
+    and num_cols^2 subplots for every plot. The figures are standalone (not pyplot managed), and each plot is rendered
+    to png before the next call clears the figure.
+    """
+    def __init__(self, figsize=(30, 30)):
+        self.figsize = figsize
+        self._figures = {}
+
+    def axes(self, num_cols):
+        if num_cols not in self._figures:
+            fig = Figure(figsize=self.figsize)
+            self._figures[num_cols] = fig, fig.subplots(num_cols, num_cols, squeeze=False)
+        fig, axs = self._figures[num_cols]
+        for ax in axs.flat:
+            ax.cla()
+        return fig, axs
+
+    def save(self, fig, savepath, writer=None):
+        # rendered now (see save_figure), before the next call clears the figure
+        save_figure(fig, savepath, writer)
+
+
+class WorkflowModel:
+    """
+    The fitted state of a Workflow run (log transform flag, scaler, normalizer, PCA and one clusterer per cluster
+    count), so new sessions can be assigned to an existing clustering without refitting anything.
+    RunWorkflow saves it once per run as model.pkl in the base output dir, with a clusterer for every count in
+    clustering_counts (so predict(df, k) scores against the z...k{k} clusters.csv).
+
+    New sessions must already be filtered and aggregated the same way as the original data (ie. look like
+    filtered_data.csv).
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.logtransform = False
+        self.scaler = None
+        self.normalizer = None
+        self.pca = None
+        self.clusterers = {}
+
+    def transform(self, df):
+        """
+        Applies the fitted preprocessing and PCA to df.
+
+        :param df: df with (at least) the columns the model was fit on
+        :return: df of the dimensions that were clustered on, with df's index
+        """
+        nparray = df[self.columns].to_numpy(dtype=np.float64, copy=True)
+        columns = self.columns
+        if self.logtransform:
+            np.log1p(nparray, out=nparray)
+        if self.scaler is not None:
+            nparray = self.scaler.transform(nparray)
+        if self.normalizer is not None:
+            nparray = self.normalizer.transform(nparray)
+        if self.pca is not None:
+            nparray = self.pca.transform(nparray)
+            columns = [f"PCA_{i}" for i in range(self.pca.n_components_)]
+        return pd.DataFrame(nparray, index=df.index, columns=columns, copy=False)
+
+    def predict(self, df, cluster_count=None):
+        """
+        :param df: df with (at least) the columns the model was fit on
+        :param cluster_count: which fitted clusterer to use. Can be left out if only one was fit.
+        :return: series of cluster labels with df's index
+        """
+        if cluster_count is None:
+            if len(self.clusterers) != 1:
+                raise ValueError(f'Model has clusterers for {sorted(self.clusterers)}, pass cluster_count')
+            cluster_count, = self.clusterers
+        clusterer = self.clusterers[cluster_count]
+        if not hasattr(clusterer, 'predict'):
+            raise ValueError(f'{clusterer} cannot assign new sessions')
+        return pd.Series(clusterer.predict(self.transform(df).to_numpy()), index=df.index, name='label')
+
+    def save(self, savepath, writer=None):
+        # pickled here so a background write never sees clusterers that were fit after this call
+        data = pickle.dumps(self)
+        if writer is not None:
+            writer.submit(utils.write_bytes, data, savepath)
+        else:
+            utils.write_bytes(data, savepath)
+
+    @staticmethod
+    def load(loadpath):
+        ## Do NOT load ANYTHING that you don't 100% trust! Malicious contents could easily harm your computer.
+        with open(loadpath, 'rb') as f:
+            return pickle.load(f)
+
+
 class Workflow:
     # fields
     DEFAULT_SCALE = "robust"
@@ -51,6 +432,7 @@ class Workflow:
         self.do_scaling = True
         self.do_normalization = False
         self.post_histogram = True
+        self.plot_boxplots = True
         self.plot_correlation = True
         self.do_PCA = True
         self.plot_scree = True
@@ -58,15 +440,27 @@ class Workflow:
         self.plot_cluster_scatter = True
         self.plot_silhouettes = True
         self.plot_radars = True
+        self.silhouette_mode = 'exact'  # 'exact', 'sampled' or 'simplified', see silhouette_values
+        self.silhouette_sample_size = SILHOUETTE_SAMPLE_SIZE
+        self.scatter_max_points = SCATTER_MAX_POINTS
+        self.async_writes = True  # save csvs and plots on background threads (see ArtifactWriter)
+        self.writer_threads = 2
+        self.writer_max_pending = 4
 
         # scikitlearn
-        self.outlier_method = None
+        self.outlier_method = None  # None or 'zscore' (mean/std), or 'robust' (median/MAD), see cu.reduce_outliers
         self.scaling_method = Workflow.DEFAULT_SCALE
         self.normalization_method = 'Normalizer'
         self.pca_dimension_count = Workflow.DEFAULT_PCA
+        self.pca_mode = 'exact'  # 'exact', 'randomized' or 'incremental', see Workflow.PCA
         self.clustering_method = Workflow.DEFAULT_CLUSTER_METHOD
         self.clustering_counts = Workflow.DEFAULT_CLUSTERS
         self.clustering_count = self.clustering_counts[0]
+        self.warm_start_clusters = False  # fit each cluster count starting from the last count's centers
+        self.cluster_workers = None  # processes to fit cluster counts in, see Workflow.ClusterSweep
+
+        # output
+        self.output_format = 'csv'  # 'csv', 'tsv', 'csv.gz', 'tsv.gz', 'parquet' or 'feather'
 
         # viz
         self.color_dict = {i: v for i, v in enumerate(plt.cm.get_cmap('tab10').colors)}
@@ -74,9 +468,12 @@ class Workflow:
         self.color_dict[-1] = (.2, .2, .2)
         self.feature_names = None
 
+        # fitted state of the last run, see WorkflowModel
+        self.model = None
+
 
     def clustering_abbrev(self):
-        cluster_abbrev = 'k' if self.clustering_method is "KMeans" else self.clustering_method
+        cluster_abbrev = CLUSTER_ABBREVS.get(self.clustering_method, self.clustering_method)
         return f'z{self.filter_options.zthresh}pca{self.pca_dimension_count}{cluster_abbrev}{self.clustering_count}'
 
     def get_base_output_dir(self):
@@ -103,15 +500,15 @@ class Workflow:
 
     def query(self, df, query_list):
         meta = []
-        for q in query_list:
-            df = df.query(q)
-            outstr = f'Query: {q}, output_shape: {df.shape}'
+        mask = np.ones(len(df), dtype=bool)
+        for q, mask in cu.cumulative_query_masks(df, query_list):
+            outstr = f'Query: {q}, output_shape: {(int(mask.sum()), df.shape[1])}'
             meta.append(outstr)
 
-        return df, meta
+        return df[mask], meta
 
     @staticmethod
-    def Histogram(df: pd.DataFrame, num_bins: int = None, title: str = None, log_scale=True, save=False, save_loc=None):
+    def Histogram(df: pd.DataFrame, num_bins: int = None, title: str = None, log_scale=True, save=False, save_loc=None, writer=None):
         title = title or 'Histograms'
         num_rows = len(df.index)
         num_bins = num_bins or min(25, num_rows)
@@ -125,12 +522,11 @@ class Workflow:
         #         ax.set_yscale('log')
         if save:
             savepath = os.path.join(save_loc, f'{title}.png')
-            plt.savefig(savepath)
-            plt.close()
+            save_figure(plt.gcf(), savepath, writer)
 
     # TODO: Graph is part cut off, i think there might be some stuff hardcoded.
     @staticmethod
-    def Correlations(df, heat_range=0.3, save=False, save_loc=None):
+    def Correlations(df, heat_range=0.3, save=False, save_loc=None, writer=None):
         plt.figure()
         seaborn.set(style="ticks")
         corr = df.corr()
@@ -142,56 +538,147 @@ class Workflow:
         title = 'Correlations'
         if save:
             savepath = os.path.join(save_loc, f'{title}.png')
-            g.figure.savefig(savepath)
+            if writer is not None:
+                writer.savefig(g.figure, savepath)
+            else:
+                g.figure.savefig(savepath)
 
     @staticmethod
-    def LogTransformed(df):
+    def LogTransformed(df, model=None):
         meta = []
         nparray = df.to_numpy()
         nparray = np.log1p(nparray)
         meta.append('LogTransform using np.long1p')
+        if model is not None:
+            model.logtransform = True
         return pd.DataFrame(nparray, columns=df.columns), meta
 
     # @df_np_df
     @staticmethod
-    def Scaled(df, scaling_method:str = DEFAULT_SCALE):
+    def Scaled(df, scaling_method:str = DEFAULT_SCALE, model=None):
         meta = []
         nparray = df.to_numpy()
-        if scaling_method == "Standard":
-            scaler = StandardScaler()
-        elif scaling_method == "Robust":
-            scaler = RobustScaler()
+        scaler = make_scaler(scaling_method)
         meta.append(f'Scaled with scikitlearn {scaler}' )
         nparray = scaler.fit_transform(nparray)
+        if model is not None:
+            model.scaler = scaler
         return pd.DataFrame(nparray, columns=df.columns), meta
 
     # @df_np_df
     @staticmethod
-    def Normalized(df):
+    def Normalized(df, model=None):
         meta = []
         nparray = df.to_numpy()
         normalizer = Normalizer()
         meta.append(f'Normalized with scikitlearn {normalizer}')
         nparray = normalizer.fit_transform(nparray)
+        if model is not None:
+            model.normalizer = normalizer
         return pd.DataFrame(nparray, columns=df.columns), meta
 
     @staticmethod
-    def PCA(df, dimension_count:int = DEFAULT_PCA):
+    def Preprocessed(df, logtransform=True, scaling_method=DEFAULT_SCALE, normalize=False, model=None):
+        """
+        Same output and meta as chaining LogTransformed, Scaled and Normalized, but the data is copied into one float
+        array once and every step transforms that array in place.
+
+        :param logtransform: apply np.log1p
+        :param scaling_method: "Standard" or "Robust" (any case), or None to skip scaling
+        :param normalize: apply a scikitlearn Normalizer
+        :param model: optional WorkflowModel to store the fitted steps on
+        :return: (preprocessed df, meta)
+        """
+        meta = []
+        nparray = df.to_numpy(dtype=np.float64, copy=True)
+        if logtransform:
+            np.log1p(nparray, out=nparray)
+            meta.append('LogTransform using np.long1p')
+        if scaling_method:
+            scaler = make_scaler(scaling_method)
+            meta.append(f'Scaled with scikitlearn {scaler}')
+            nparray = scaler.set_params(copy=False).fit_transform(nparray)
+        if normalize:
+            normalizer = Normalizer()
+            meta.append(f'Normalized with scikitlearn {normalizer}')
+            nparray = normalizer.set_params(copy=False).fit_transform(nparray)
+        if model is not None:
+            model.logtransform = logtransform
+            model.scaler = scaler if scaling_method else None
+            model.normalizer = normalizer if normalize else None
+        return pd.DataFrame(nparray, columns=df.columns, copy=False), meta
+
+    @staticmethod
+    def Decompose(df):
+        """
+        Fits a full rank PCA to df, for sharing between PlotScree and PCA so a run only decomposes the data once.
+        Uses the d x d covariance matrix where scikitlearn supports it, so memory doesn't grow with the session count
+        squared.
+
+        :return: fitted scikitlearn PCA
+        """
+        nparray = df.to_numpy()
+        try:
+            return PCA(svd_solver='covariance_eigh').fit(nparray)
+        except ValueError:  # scikitlearn < 1.5
+            return PCA(svd_solver='full').fit(nparray)
+
+    @staticmethod
+    def PCA(df, dimension_count:int = DEFAULT_PCA, model=None, pca_mode='exact', chunk_rows=PCA_CHUNK_ROWS,
+            decomposition=None):
+        """
+        :param pca_mode: 'exact' (scikitlearn's default PCA), 'randomized' (randomized truncated SVD, much faster when
+        dimension_count is small) or 'incremental' (IncrementalPCA fit and applied chunk_rows rows at a time, so the
+        data is never centered or decomposed as a whole)
+        :param chunk_rows: rows per chunk for incremental mode
+        :param decomposition: optional output of Workflow.Decompose(df). In exact mode its leading components are used
+        instead of decomposing df again.
+        """
         meta = []
         nparray = df.to_numpy()
-        pca = PCA(n_components=dimension_count)
+        if pca_mode != 'exact':
+            decomposition = None
+        if decomposition is not None:
+            pca = truncate_pca(decomposition, dimension_count)
+        elif pca_mode == 'exact':
+            pca = PCA(n_components=dimension_count)
+        elif pca_mode == 'randomized':
+            pca = PCA(n_components=dimension_count, svd_solver='randomized', random_state=0)
+        elif pca_mode == 'incremental':
+            pca = IncrementalPCA(n_components=dimension_count, batch_size=chunk_rows)
+        else:
+            raise ValueError(f'Unknown pca_mode {pca_mode!r}, expected one of {PCA_MODES}')
         meta.append(f'PCA df calculated with scikitlearn {pca}')
-        nparray = pca.fit_transform(nparray)
+        if pca_mode == 'incremental':
+            # every chunk gets at least chunk_rows rows, as partial_fit needs at least dimension_count rows
+            bounds = np.linspace(0, len(nparray), max(1, len(nparray) // chunk_rows) + 1).astype(int)
+            chunks = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+            for chunk in chunks:
+                pca.partial_fit(nparray[chunk])
+            transformed = np.empty((len(nparray), dimension_count))
+            for chunk in chunks:
+                transformed[chunk] = pca.transform(nparray[chunk])
+            nparray = transformed
+            meta.append(f'PCA solver: incremental, {len(chunks)} chunks of ~{bounds[1]} rows')
+        else:
+            nparray = pca.transform(nparray) if decomposition is not None else pca.fit_transform(nparray)
+            meta.append(f'PCA solver: {pca_mode} ({getattr(pca, "_fit_svd_solver", pca.svd_solver)})')
+        if model is not None:
+            model.pca = pca
         PCA_names = [f"PCA_{i}" for i in range(dimension_count)]
         return pd.DataFrame(nparray, columns=PCA_names), meta
 
     @staticmethod
-    def PlotScree(df, save=False, save_loc=None):
-        nparray = df.to_numpy()
-        U, S, V = np.linalg.svd(nparray)
-        eigvals = S ** 2 / np.sum(S ** 2)
+    def PlotScree(df, save=False, save_loc=None, writer=None, decomposition=None):
+        """
+        Plots the explained variance ratio of each principal component of df.
+
+        :param decomposition: optional output of Workflow.Decompose(df), which is computed if not given
+        """
+        decomposition = decomposition if decomposition is not None else Workflow.Decompose(df)
+        eigvals = decomposition.explained_variance_ratio_
         fig = plt.figure(figsize=(8, 5))
-        singular_vals = np.arange(nparray.shape[1]) + 1
+        singular_vals = np.arange(len(eigvals)) + 1
         plt.plot(singular_vals, eigvals, 'ro-', linewidth=2)
         title = 'Scree Plot'
         plt.title(title)
@@ -200,29 +687,51 @@ class Workflow:
 
         if save:
             savepath = os.path.join(save_loc, f'{title}.png')
-            plt.savefig(savepath)
-            plt.close()
+            save_figure(fig, savepath, writer)
         return
 
     @staticmethod
-    def Cluster(df, cluster_count: int=DEFAULT_CLUSTERS[0], clustering_method=DEFAULT_CLUSTER_METHOD):
-        meta = []
+    def Cluster(df, cluster_count: int=DEFAULT_CLUSTERS[0], clustering_method=DEFAULT_CLUSTER_METHOD, model=None,
+                init_centers=None):
+        """
+        :param clustering_method: "KMeans", "MiniBatchKMeans" (much faster for large session counts) or "DBSCAN"
+        :param init_centers: optional centers from a fit with fewer clusters to warm start from
+        """
+        clusterer, labels, meta = fit_clusterer(df.to_numpy(), cluster_count, clustering_method, init_centers)
+        if model is not None and clusterer is not None:
+            model.clusterers[cluster_count] = clusterer
+        return labels, meta
+
+    @staticmethod
+    def ClusterSweep(df, cluster_counts, clustering_method=DEFAULT_CLUSTER_METHOD, model=None, warm_start=False,
+                     workers=None):
+        """
+        Runs Workflow.Cluster for each of cluster_counts.
+
+        :param warm_start: fit the counts in increasing order, starting each KMeans/MiniBatchKMeans fit from the
+        previous fit's centers plus new centers seeded by the k-means++ rule, see warm_start_centers (one init
+        instead of the default restarts)
+        :param workers: number of processes to fit independent counts in (None or 1 fits serially). Ignored when
+        warm starting, since each fit then depends on the last.
+        :return: List[(labels, meta)] in the order of cluster_counts
+        """
         nparray = df.to_numpy()
-        if clustering_method == "KMeans":
-            clusterer = KMeans(n_clusters=cluster_count)
-            # For future, include calculated distances.
-            # In the future, this will let us find centers:
-            # distances = clusterer.transform(nparray)
-            # nparray = np.concatenate((distances, labels))
-        # elif clustering_method == "FuzzyCMeans":
-        #     pass
-        elif clustering_method == "DBSCAN":
-            clusterer = DBSCAN(eps=0.3, min_samples=10)
+        results = {}
+        if warm_start:
+            init_centers = None
+            for cluster_count in sorted(set(cluster_counts)):
+                clusterer, labels, meta = fit_clusterer(nparray, cluster_count, clustering_method, init_centers)
+                results[cluster_count] = (clusterer, labels, meta)
+                init_centers = getattr(clusterer, 'cluster_centers_', None)
+        elif workers and workers > 1 and len(cluster_counts) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(cluster_counts))) as executor:
+                fits = executor.map(partial(_fit_clusterer_for_count, nparray, clustering_method), cluster_counts)
+                results = dict(zip(cluster_counts, fits))
         else:
-            return [], meta
-        labels = clusterer.fit_predict(nparray)
-        meta.append(f'Labels calculated via clusterer: {clusterer}')
-        return labels, meta
+            results = {k: fit_clusterer(nparray, k, clustering_method) for k in cluster_counts}
+        if model is not None:
+            model.clusterers.update({k: clusterer for k, (clusterer, _, _) in results.items() if clusterer is not None})
+        return [results[k][1:] for k in cluster_counts]
 
         # for a,l in zip(PCA_dims, labels):
         #     b =  clustering.cluster_centers_[l]
@@ -232,9 +741,15 @@ class Workflow:
         # df['PCA2 Offset'] = np.array(distances)[:,1]
 
     @staticmethod
-    def PlotSilhouettes(dimension_data: pd.DataFrame, labels: pd.DataFrame, title=None, clustering_abbrev=None, save=False, save_loc=None):
+    def PlotSilhouettes(dimension_data: pd.DataFrame, labels: pd.DataFrame, title=None, clustering_abbrev=None, save=False, save_loc=None, writer=None,
+                        mode='exact', sample_size=SILHOUETTE_SAMPLE_SIZE):
+        """
+        :param mode: 'exact', 'sampled' or 'simplified', see silhouette_values. Shown on the x axis, and in the title
+        for the approximate modes.
+        :param sample_size: roughly how many sessions to compute silhouettes for in sampled mode
+        """
         np_dimensions = dimension_data.to_numpy()
-        silhouette_vals = silhouette_samples(np_dimensions, labels)
+        silhouette_vals, labels, avg_score, ci = silhouette_values(np_dimensions, labels, mode, sample_size)
 
         # Silhouette plot
         fig, ax1 = plt.subplots(1, 1)
@@ -249,62 +764,91 @@ class Workflow:
             ax1.text(-0.03, (y_lower + y_upper) / 2, str(i + 1))
             y_lower += len(cluster_silhouette_vals)
 
-        # Get the average silhouette score and plot it
-        avg_score = np.mean(silhouette_vals)
+        # Plot the average silhouette score
         ax1.axvline(avg_score, linestyle='--', linewidth=2, color='green')
+        if ci is not None:
+            ax1.axvspan(avg_score - ci, avg_score + ci, color='green', alpha=0.15)
         ax1.set_yticks([])
         ax1.set_xlim([-0.1, 1])
-        ax1.set_xlabel('Silhouette coefficient values')
+        mode_desc = f'sampled, n={len(silhouette_vals)}' if mode == 'sampled' else mode
+        ax1.set_xlabel(f'Silhouette coefficient values ({mode_desc})')
         ax1.set_ylabel('Cluster labels')
-        title = title or f'Silhouettes {clustering_abbrev} Avg={int(avg_score*100)}%'
+        if not title:
+            title = f'Silhouettes {clustering_abbrev} Avg={int(avg_score*100)}%'
+            if ci is not None:
+                title += f' +-{ci*100:.1f}%'
+            if mode != 'exact':
+                title += f' ({mode_desc})'
         ax1.set_title(title, y=1.02)
         if save:
             savepath = os.path.join(save_loc, f'{title}.png')
-            plt.savefig(savepath)
-            plt.close()
+            save_figure(fig, savepath, writer)
 
         return
 
     @staticmethod
-    def scatter(df, labels, color_dict, title='Scatter', save=False, save_loc=None):
+    def scatter(df, labels, color_dict, title='Scatter', save=False, save_loc=None, writer=None,
+                max_points=SCATTER_MAX_POINTS, renderer=None):
+        """
+        Scatter matrix of df's columns colored by label, see draw_scatter_matrix.
+
+        :param max_points: number of sessions to scatter (stratified by label). The diagonal histograms use every session.
+        :param renderer: optional ScatterMatrix to draw on, so repeated calls reuse one figure. Otherwise a new pyplot
+        figure is made.
+        """
         num_cols = len(df.columns)
-        color_array = [color_dict[c] for c in labels]
-        fig, axs = plt.subplots(num_cols, num_cols, figsize=(30, 30))
-        for x in range(num_cols):
-            for y in range(num_cols):
-                axs[x, y].scatter(df.iloc[:, x], df.iloc[:, y], c=color_array)
-                axs[x, y].set_xlabel(df.columns[x])
-                axs[x, y].set_ylabel(df.columns[y])
+        if renderer is not None:
+            fig, axs = renderer.axes(num_cols)
+        else:
+            fig, axs = plt.subplots(num_cols, num_cols, figsize=(30, 30), squeeze=False)
+        draw_scatter_matrix(axs, df, labels, color_dict, max_points)
         if save:
             savepath = os.path.join(save_loc, f'{title}.png')
-            plt.savefig(savepath)
-            plt.close()
+            if renderer is not None:
+                renderer.save(fig, savepath, writer)
+            else:
+                save_figure(fig, savepath, writer)
 
     @staticmethod
     def radar_from_cluster_csv(csv_path, optionsgroup, savedir=None ):
         print('here')
         index_col = [0,1] if optionsgroup.game.upper() == 'LAKELAND' else 0
-        df = pd.read_csv(csv_path, index_col=index_col, comment='#')
+        df, _ = cu.open_df_from_path_with_meta(csv_path, index_col=index_col)
         labels = list(df['label'].to_numpy())
         df = df.drop('label', axis=1)
         w = Workflow(init_df=df, import_meta="", filter_options=optionsgroup)
         w.radarCharts(df, labels, savedir=savedir)
 
-    def radarCharts(self, df, labels, save=True, savedir=None):
+    @staticmethod
+    def ClusterSummary(df, labels):
+        """
+        Per cluster feature stats against the whole df, in one groupby:
+        C{c}_zscore (cluster mean - mean) / std, C{c}_%mean cluster mean / mean * 100 and C{c}_%std cluster std / std * 100,
+        all floored to 2 decimals.
+
+        :return: df with 3 rows per cluster (in label order) and a column per numeric feature
+        """
+        df = df.select_dtypes(include='number')
+        grouped = df.groupby(np.asarray(labels))
+        means, stds = grouped.mean(), grouped.std()
+        global_mean, global_std = df.mean(), df.std()
+        stats = {'zscore': (means - global_mean) / global_std,
+                 '%mean': means / global_mean * 100,
+                 '%std': stds / global_std * 100}
+        # interleave to C0_zscore, C0_%mean, C0_%std, C1_zscore, ...
+        values = np.stack([stat.to_numpy(dtype=np.float64) for stat in stats.values()], axis=1)
+        index = [f'C{c}_{stat}' for c in means.index for stat in stats]
+        values = np.floor(values.reshape(len(index), len(df.columns)) * 100) * .01
+        return pd.DataFrame(values, index=index, columns=df.columns)
+
+    def radarCharts(self, df, labels, save=True, savedir=None, writer=None, summary_df=None):
+        """
+        :param summary_df: Workflow.ClusterSummary(df, labels), computed if not given
+        """
         print('radarCharts')
         categories = self.filter_options.finalfeats_readable
-        description_df = df.describe()
-        summary_df = pd.DataFrame(columns=description_df.columns)
-        clusters = set(labels)
-        cluster_dict = {}
-        for c in clusters:
-            cluster_dict[c] = df[labels == c]
-            cluster_df = cluster_dict[c].describe()
-            summary_df.loc[f'C{c}_zscore', :] = (cluster_df.loc['mean', :] - description_df.loc['mean', :]) / description_df.loc[
-                                                                                                       'std', :]
-            summary_df.loc[f'C{c}_%mean', :] = (cluster_df.loc['mean', :] / description_df.loc['mean', :]) * 100
-            summary_df.loc[f'C{c}_%std', :] = (cluster_df.loc['std', :] / description_df.loc['std', :]) * 100
-        summary_df = summary_df.apply(lambda x: (x * 100) // 1 * .01)
+        summary_df = summary_df if summary_df is not None else Workflow.ClusterSummary(df, labels)
+        cluster_dict = pd.Series(np.asarray(labels)).value_counts().to_dict()  # cluster -> size
 
         def make_spider(color, i):
             offset = .25 * pi
@@ -325,7 +869,7 @@ class Workflow:
             graph_name = tdf.index[i]
             ax.plot(angles, values, color=color, linewidth=2, linestyle='solid')
             ax.fill(angles, values, color=color, alpha=0.4)
-            plt.title(f'Cluster {i} (n={len(cluster_dict[i])})', size=11, color=color, y=1.1)
+            plt.title(f'Cluster {i} (n={cluster_dict[i]})', size=11, color=color, y=1.1)
 
         # number of variable
         for var in ['zscore', '%mean', '%std']:
@@ -344,22 +888,30 @@ class Workflow:
                 make_spider(self.color_dict[i], i)
             fig.subplots_adjust(wspace=0.4)
             if save:
-                plt.savefig(os.path.join(self.get_cluster_output_dir(),f'radar_{var}.png'))
-                plt.close()
+                save_figure(fig, os.path.join(self.get_cluster_output_dir(),f'radar_{var}.png'), writer)
         pass
 
-    def save_csv_and_meta(self, df, meta_list, save_dir, csv_name, meta_name=None, permissions='w+'):
-        if csv_name.endswith(('.tsv', '.csv')):
-            extension = csv_name[-4:]
-            csv_name = csv_name[:-4]
+    def save_csv_and_meta(self, df, meta_list, save_dir, csv_name, meta_name=None, permissions='w+', writer=None):
+        if writer is not None:
+            # meta_list keeps growing in RunWorkflow, so queue a snapshot of it
+            writer.submit(self.save_csv_and_meta, df, list(meta_list), save_dir, csv_name, meta_name, permissions)
+            return None, []
+        if csv_name.endswith(('.csv.gz', '.tsv.gz')):
+            csv_name, extension = csv_name[:-7], csv_name[-7:]
+        elif csv_name.endswith(('.tsv', '.csv') + utils.COLUMNAR_EXTENSIONS):
+            csv_name, extension = os.path.splitext(csv_name)
         else:
             extension = '.csv'
-        separator = '\t' if extension == '.tsv' else ','
+        separator = '\t' if extension.startswith('.tsv') else ','
         meta_name = meta_name or csv_name+ '_meta.txt'
         meta_text = 'Metadata:\n'+'\n'.join(meta_list)
         with open(os.path.join(save_dir, meta_name), permissions) as f:
             f.write(meta_text)
-        with open(os.path.join(save_dir, csv_name)+extension, permissions) as f:
+        if extension in utils.COLUMNAR_EXTENSIONS:
+            utils.write_columnar_with_meta(df, os.path.join(save_dir, csv_name)+extension,
+                                           [l.strip() for l in meta_text.splitlines()])
+            return None, []
+        with utils.open_text(os.path.join(save_dir, csv_name)+extension, permissions) as f:
             for l in meta_text.splitlines():
                 f.write(f'# {l}\n')
             f.write('\n')
@@ -368,6 +920,21 @@ class Workflow:
         return None, []
 
     def RunWorkflow(self):
+        writer = ArtifactWriter(max_workers=self.writer_threads, max_pending=self.writer_max_pending) \
+            if self.async_writes else None
+        try:
+            ret = self._RunWorkflowSteps(writer)
+        except BaseException:
+            if writer is not None:
+                writer.close(raise_errors=False)
+            raise
+        if writer is not None:
+            if self.verbose:
+                print('Waiting for output files to finish writing.')
+            writer.close()
+        return ret
+
+    def _RunWorkflowSteps(self, writer=None):
         def requestPCADims():
             inp = input('pca dims? ')
             try:
@@ -384,13 +951,16 @@ class Workflow:
         if self.verbose:
             print('Starting workflow.')
             print('Saving to:', self.get_base_output_dir())
-        original_df, meta = cu.full_filter(df=self._df, import_meta=self._df_import_meta, options=self.filter_options, outpath=self.get_base_output_dir())
+        original_df, meta = cu.full_filter(df=self._df, import_meta=self._df_import_meta, options=self.filter_options, outpath=self.get_base_output_dir(),
+                                           show_graphs=self.plot_boxplots, plot_executor=writer,
+                                           method=self.outlier_method or 'zscore')
         if self.further_filter_query_list is not None:
             original_df, md = self.query(original_df, self.further_filter_query_list)
             meta.extend(md)
-        self.save_csv_and_meta(original_df, meta, self.get_base_output_dir(), 'filtered_data')
+        self.save_csv_and_meta(original_df, meta, self.get_base_output_dir(), f'filtered_data.{self.output_format}', writer=writer)
         working_df = original_df.copy()
         original_cols = list(working_df.columns)
+        self.model = WorkflowModel(original_cols)
 
         print(f"Ok, we've done the filtering and such, time to get a random sample of session ids. First, let's check the start")
         print(working_df.head())
@@ -403,36 +973,35 @@ class Workflow:
         # show working_df before any processing
 
         if self.pre_histogram:
-            Workflow.Histogram(working_df, title='Raw Histogram', save=True, save_loc=self.get_base_output_dir())
-        # do log transform
-        if self.do_logtransform:
-            working_df, md = Workflow.LogTransformed(working_df)
-            meta.extend(md)
-        # scale working_df
-        if self.do_scaling:
-            working_df, md = Workflow.Scaled(working_df, self.scaling_method)
-            meta.extend(md)
-        # do normalization
-        if self.do_normalization:
-            working_df, md = Workflow.Normalized(working_df)
+            Workflow.Histogram(working_df, title='Raw Histogram', save=True, save_loc=self.get_base_output_dir(), writer=writer)
+        # log transform, scale and normalize in one pass
+        if self.do_logtransform or self.do_scaling or self.do_normalization:
+            working_df, md = Workflow.Preprocessed(working_df, logtransform=self.do_logtransform,
+                                                   scaling_method=self.scaling_method if self.do_scaling else None,
+                                                   normalize=self.do_normalization, model=self.model)
             meta.extend(md)
         # show working_df after transformation
         if self.post_histogram:
-            Workflow.Histogram(working_df, title='Preprocessed Histogram', save=True, save_loc=self.get_base_output_dir())
+            Workflow.Histogram(working_df, title='Preprocessed Histogram', save=True, save_loc=self.get_base_output_dir(), writer=writer)
 
         # correlation
         if self.plot_correlation:
-            Workflow.Correlations(working_df, save=True, save_loc=self.get_base_output_dir())
+            Workflow.Correlations(working_df, save=True, save_loc=self.get_base_output_dir(), writer=writer)
 
-        # scree and PCA
+        # scree and PCA, sharing one decomposition of working_df
+        decomposition = None
+        if self.plot_scree or (self.do_PCA and self.pca_mode == 'exact'):
+            decomposition = Workflow.Decompose(working_df)
         if self.plot_scree:
-            Workflow.PlotScree(working_df, save=True, save_loc=self.get_base_output_dir())
+            Workflow.PlotScree(working_df, save=True, save_loc=self.get_base_output_dir(), writer=writer,
+                               decomposition=decomposition)
         if self.do_PCA:
             while self.pca_dimension_count is None:
                 requestPCADims()
             if self.verbose:
                 print('Starting PCA.')
-            pca_df, md = Workflow.PCA(working_df, self.pca_dimension_count)
+            pca_df, md = Workflow.PCA(working_df, self.pca_dimension_count, model=self.model, pca_mode=self.pca_mode,
+                                      decomposition=decomposition)
             meta.extend(md)
             cluster_df = pca_df
             meta.append('Cluster on PCA dims')
@@ -444,45 +1013,58 @@ class Workflow:
         if self.do_clustering:
             while self.clustering_counts is None:
                 requestClusterCount()
-            for cluster_count in self.clustering_counts:
+            if self.verbose:
+                print(f'Starting clustering k={self.clustering_counts}')
+            sweep = Workflow.ClusterSweep(cluster_df, self.clustering_counts, clustering_method=self.clustering_method,
+                                          model=self.model, warm_start=self.warm_start_clusters,
+                                          workers=self.cluster_workers)
+            scatter_renderer = ScatterMatrix()
+            for cluster_count, (labels, md) in zip(self.clustering_counts, sweep):
                 self.clustering_count = cluster_count
-                if self.verbose:
-                    print(f'Starting clustering k={self.clustering_count}')
-                labels, md = Workflow.Cluster(cluster_df, clustering_method=self.clustering_method, cluster_count=cluster_count)
                 meta.extend(md)
 
                 if self.plot_silhouettes:
-                    Workflow.PlotSilhouettes(cluster_df, labels, save=True, save_loc=self.get_base_output_dir())
+                    Workflow.PlotSilhouettes(cluster_df, labels, save=True, save_loc=self.get_base_output_dir(), writer=writer,
+                                             mode=self.silhouette_mode, sample_size=self.silhouette_sample_size)
                 if self.plot_cluster_scatter:
-                    Workflow.scatter(pca_df, [0]*len(labels), color_dict=self.color_dict, title='PCA No Label Scatter', save=True, save_loc=self.get_base_output_dir())
-                    Workflow.scatter(working_df, labels, color_dict=self.color_dict, title='Preprocessed Scatter', save=True, save_loc=self.get_base_output_dir())
-                    Workflow.scatter(pca_df, labels, color_dict=self.color_dict, title=f'PCA Scatter', save=True, save_loc=self.get_base_output_dir())
-                    Workflow.scatter(original_df, labels, color_dict=self.color_dict, title='Raw Scatter', save=True, save_loc=self.get_base_output_dir())
+                    scatter_kwargs = dict(color_dict=self.color_dict, save=True, save_loc=self.get_base_output_dir(), writer=writer,
+                                          max_points=self.scatter_max_points, renderer=scatter_renderer)
+                    Workflow.scatter(pca_df, [0]*len(labels), title='PCA No Label Scatter', **scatter_kwargs)
+                    Workflow.scatter(working_df, labels, title='Preprocessed Scatter', **scatter_kwargs)
+                    Workflow.scatter(pca_df, labels, title=f'PCA Scatter', **scatter_kwargs)
+                    Workflow.scatter(original_df, labels, title='Raw Scatter', **scatter_kwargs)
 
+                summary_df = Workflow.ClusterSummary(original_df, labels)
+                self.save_csv_and_meta(summary_df, meta, self.get_cluster_output_dir(), f'cluster_summary.{self.output_format}', writer=writer)
                 if self.plot_radars:
-                    self.radarCharts(original_df, labels)
-                self.save_csv_and_meta(cluster_df, meta, self.get_cluster_output_dir(), 'data_clustered_on')
-                original_df['label'] = labels
-                self.save_csv_and_meta(original_df, meta, self.get_cluster_output_dir(), 'clusters')
-                original_df = original_df.drop('label', axis=1)
+                    self.radarCharts(original_df, labels, writer=writer, summary_df=summary_df)
+                self.save_csv_and_meta(cluster_df, meta, self.get_cluster_output_dir(), f'data_clustered_on.{self.output_format}', writer=writer)
+                # a new frame rather than a label column added and dropped, so a queued write never sees it change
+                self.save_csv_and_meta(original_df.assign(label=labels), meta, self.get_cluster_output_dir(), f'clusters.{self.output_format}', writer=writer)
 
+        # every cluster count is already fit by ClusterSweep, so one model covers all the cluster output dirs
+        self.model.save(os.path.join(self.get_base_output_dir(), 'model.pkl'), writer=writer)
         return working_df, meta
 
 
 
 
 def add_cluster_features_to_df(pipeline, df, data):
-    pipeline.fit(data)
-    PCA_dims = pipeline[:-1].transform(data)
+    """
+    Fits pipeline (preprocessing/PCA steps ending in a clusterer with cluster_centers_, eg. KMeans) to data once, and
+    adds each session's position relative to the cluster centers to df (in place, rows in the same order as data):
+    PCA{i} Offset (session - its center) for every clustered dimension, Center Distance (euclidean distance to its
+    center) and Distance to Center {c} for every cluster c.
+    """
+    PCA_dims = pipeline[:-1].fit_transform(data)
     clustering = pipeline[-1]
-    labels = clustering.predict(PCA_dims)
-    distances = []
-    for a, l in zip(PCA_dims, labels):
-        b = clustering.cluster_centers_[l]
-        distances.append(a - b)
-    labels = labels
-    df['PCA1 Offset'] = np.array(distances)[:, 0]
-    df['PCA2 Offset'] = np.array(distances)[:, 1]
+    labels = clustering.fit_predict(PCA_dims)
+    centers = clustering.cluster_centers_
+    offsets = PCA_dims - centers[labels]
+    distances = pairwise_distances(PCA_dims, centers)
+    df[[f'PCA{i + 1} Offset' for i in range(offsets.shape[1])]] = offsets
+    df['Center Distance'] = distances[np.arange(len(labels)), labels]
+    df[[f'Distance to Center {c}' for c in range(len(centers))]] = distances
 
 
 # def main():
@@ -0,0 +1,157 @@
+"""
+Rough timing benchmarks for the data loading and clustering utils.
+
+Usage:
+python benchmarks.py
+
+Each benchmark builds its own synthetic data in a temp directory, so nothing here needs the real proc exports.
+"""
+import os
+import tempfile
+from time import perf_counter
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+import pandas as pd
+
+import feature_utils as feat_util
+from Workflow import Workflow, WorkflowModel, PCA_MODES
+
+
+def make_synthetic_proc_zips(save_dir, num_files, num_rows=5000, num_cols=200, seed=0):
+    """
+    Writes num_files zipped proc CSVs shaped like the OGD exports (leading # lines, sessionID, lvlN_ features).
+
+    :param save_dir: directory to write the zips to
+    :param num_files: number of zips ("months") to write
+    :param num_rows: number of sessions per file
+    :param num_cols: number of feature columns per file
+    :param seed: random seed
+    :return: list of zip paths
+    """
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(num_files):
+        df = pd.DataFrame(rng.poisson(3, size=(num_rows, num_cols)),
+                          columns=[f'lvl{c % 10}_feat{c // 10}' for c in range(num_cols)])
+        df.insert(0, 'sessionID', np.arange(num_rows) + i * num_rows)
+        csv_name = f'SYNTHETIC_{i:02d}_proc.csv'
+        path = os.path.join(save_dir, f'SYNTHETIC_{i:02d}_proc.zip')
+        with ZipFile(path, 'w', compression=ZIP_DEFLATED) as zf:
+            zf.writestr(csv_name, f'# synthetic proc file {i}\n' + df.to_csv(index=False))
+        paths.append(path)
+    return paths
+
+
+def _quadratic_getLogDFbyPath(proc_paths, index_cols):
+    # the old loader, which grew the df one file at a time
+    df = pd.DataFrame()
+    for next_path in proc_paths:
+        next_file, _ = feat_util.openZipFromPath(next_path)
+        with next_file.open(next_file.namelist()[0]) as f:
+            df = pd.concat([df, pd.read_csv(f, index_col=index_cols, comment='#')], sort=True)
+    return df
+
+
+def benchmark_getLogDFbyPath(num_files=12, num_rows=5000, num_cols=200, workers=None):
+    """
+    Times getLogDFbyPath against the old per-file concat on num_files synthetic proc zips.
+    If workers is given, also times getLogDFbyPath(workers=workers).
+
+    :return: dict of timings in seconds
+    """
+    index_cols = ['sessionID']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = make_synthetic_proc_zips(tmp_dir, num_files, num_rows=num_rows, num_cols=num_cols)
+
+        start = perf_counter()
+        _quadratic_getLogDFbyPath(paths, index_cols)
+        quadratic_time = perf_counter() - start
+
+        start = perf_counter()
+        df, metadata = feat_util.getLogDFbyPath(paths, index_cols=index_cols)
+        linear_time = perf_counter() - start
+
+        if workers:
+            start = perf_counter()
+            parallel_df, parallel_metadata = feat_util.getLogDFbyPath(paths, index_cols=index_cols, workers=workers)
+            parallel_time = perf_counter() - start
+            assert parallel_metadata == metadata
+            assert parallel_df.equals(df)
+
+    assert len(metadata) == num_files
+    assert df.shape == (num_files * num_rows, num_cols + 1)
+    timings = {'per_file_concat': quadratic_time, 'single_concat': linear_time}
+    if workers:
+        timings[f'single_concat_{workers}_workers'] = parallel_time
+    print(f'getLogDFbyPath {num_files} files x {df.shape}: {timings}')
+    return timings
+
+
+def make_synthetic_features(num_rows, num_cols, rank=5, noise=0.5, seed=0):
+    """
+    Low rank plus noise feature matrix, roughly what the scaled aggregate features look like to PCA.
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(num_rows, rank)) @ rng.normal(size=(rank, num_cols))
+    data += noise * rng.normal(size=(num_rows, num_cols))
+    return pd.DataFrame(data, columns=[f'feat{c}' for c in range(num_cols)])
+
+
+def benchmark_pca_modes(num_rows=200000, num_cols=60, dimension_count=3, pca_modes=PCA_MODES):
+    """
+    Times Workflow.PCA in each pca_mode and compares the variance it explains with the exact solver's.
+
+    :return: dict of pca_mode -> (seconds, explained variance of the returned dims / exact's)
+    """
+    df = make_synthetic_features(num_rows, num_cols)
+    total_var = df.var(ddof=0).sum()
+    results = {}
+    for pca_mode in pca_modes:
+        start = perf_counter()
+        pca_df, _ = Workflow.PCA(df, dimension_count, pca_mode=pca_mode)
+        fit_time = perf_counter() - start
+        results[pca_mode] = (round(fit_time, 3), float(pca_df.var(ddof=0).sum() / total_var))
+    if 'exact' in results:
+        exact_ratio = results['exact'][1]
+        results = {mode: (t, round(ratio / exact_ratio, 6)) for mode, (t, ratio) in results.items()}
+    print(f'Workflow.PCA {df.shape} -> {dimension_count} dims (seconds, explained variance vs exact): {results}')
+    return results
+
+
+def benchmark_cluster_sweep(num_rows=200000, dimension_count=3, cluster_counts=range(2, 16), workers=None):
+    """
+    Times Workflow.ClusterSweep over cluster_counts for plain KMeans against MiniBatchKMeans, cold and warm started.
+
+    :return: dict of setting -> (seconds, total inertia over the sweep / KMeans')
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=4, size=(8, dimension_count))
+    df = pd.DataFrame(centers[rng.integers(len(centers), size=num_rows)] + rng.normal(size=(num_rows, dimension_count)))
+    cluster_counts = list(cluster_counts)
+    settings = {'KMeans': dict(clustering_method='KMeans'),
+                'KMeans_warm': dict(clustering_method='KMeans', warm_start=True),
+                'MiniBatchKMeans': dict(clustering_method='MiniBatchKMeans'),
+                'MiniBatchKMeans_warm': dict(clustering_method='MiniBatchKMeans', warm_start=True)}
+    if workers:
+        settings[f'MiniBatchKMeans_{workers}_workers'] = dict(clustering_method='MiniBatchKMeans', workers=workers)
+    results = {}
+    for name, kwargs in settings.items():
+        model = WorkflowModel(df.columns)
+        start = perf_counter()
+        Workflow.ClusterSweep(df, cluster_counts, model=model, **kwargs)
+        sweep_time = perf_counter() - start
+        inertia = sum(-model.clusterers[k].score(df.to_numpy()) for k in cluster_counts)
+        results[name] = [round(sweep_time, 2), inertia]
+    base_inertia = results['KMeans'][1]
+    for name in results:
+        results[name][1] = round(results[name][1] / base_inertia, 4)
+    print(f'Workflow.ClusterSweep {df.shape}, k={cluster_counts[0]}..{cluster_counts[-1]} '
+          f'(seconds, inertia vs KMeans): {results}')
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_getLogDFbyPath(workers=os.cpu_count())
+    benchmark_pca_modes()
+    benchmark_cluster_sweep(workers=os.cpu_count())
@@ -19,7 +19,9 @@ sys.path.append('.')
 import Notebooks.Clustering.cluster_utils as cu
 
 """
+import hashlib
 import os
+import re
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -28,9 +30,11 @@ import urllib.request
 import utils as utils
 import ipywidgets as widgets
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from io import BytesIO
 from matplotlib import pyplot as plt
-from scipy import stats
+from matplotlib.figure import Figure
 from typing import Optional, List, Iterable
 from zipfile import ZipFile
 from sklearn.metrics import confusion_matrix, classification_report
@@ -38,6 +42,8 @@ from sklearn.metrics import plot_precision_recall_curve, plot_confusion_matrix,
 from sklearn.metrics import f1_score, roc_auc_score, roc_curve, accuracy_score
 from datetime import datetime
 import pickle
+import shutil
+import tempfile
 from collections import Counter
 
 
@@ -77,15 +83,27 @@ def print_options(meta):
     print(f'options({inner}\n)')
 
 
-def openZipFromURL(url):
+STREAM_CHUNKSIZE = 50000  # rows per chunk when parsing proc CSVs with stream=True and compact=True
+
+
+def openZipFromURL(url, spool=False):
     """
 
     :param url: url pointing to a zipfile
+    :param spool: if True, copy the download to a temp file in blocks instead of holding the whole archive in memory.
     :return: zipfile object, list of metadata lines
     """
     metadata = [f'Import from f{url}']
     resp = urllib.request.urlopen(url)
-    zipfile = ZipFile(BytesIO(resp.read()))
+    if spool:
+        # the temp file is deleted when spool_file is closed. ZipFile.close() doesn't close a file object passed to it,
+        # so callers close zipfile.fp themselves (see readZipFromURL)
+        spool_file = tempfile.TemporaryFile()
+        shutil.copyfileobj(resp, spool_file, length=1024*1024)
+        spool_file.seek(0)
+        zipfile = ZipFile(spool_file)
+    else:
+        zipfile = ZipFile(BytesIO(resp.read()))
 
     return zipfile, metadata
 
@@ -102,74 +120,343 @@ def openZipFromPath(path):
     return zipfile, metadata
 
 
-def readCSVFromPath(path, index_cols):
+def compact_dtypes(df, category_ratio=0.5):
+    """
+    Downcasts columns to smaller dtypes: floats to float32, ints to the smallest int that holds their range,
+    and low cardinality string columns to category. Columns that are already compact are left alone.
+
+    :param df: dataframe to downcast
+    :param category_ratio: string columns with fewer than category_ratio*len(df) unique values become category
+    :return: df with compact dtypes
+    """
+    dtype_map = {}
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_float_dtype(dtype) and dtype != np.float32:
+            dtype_map[col] = np.float32
+        elif pd.api.types.is_integer_dtype(dtype) and not isinstance(dtype, pd.CategoricalDtype) and len(df):
+            col_min, col_max = df[col].min(), df[col].max()
+            for int_type in [np.int8, np.int16, np.int32]:
+                if np.iinfo(int_type).min <= col_min and col_max <= np.iinfo(int_type).max:
+                    if dtype != int_type:
+                        dtype_map[col] = int_type
+                    break
+        elif (pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)) \
+                and not isinstance(dtype, pd.CategoricalDtype) \
+                and df[col].nunique() < category_ratio * len(df):
+            dtype_map[col] = 'category'
+    return df.astype(dtype_map) if dtype_map else df
+
+
+def get_options_columns(options, index_cols=None):
+    """
+    Gets the set of proc columns that full_filter(df, meta, options, ...) reads: index columns, columns named in the
+    filter queries, the lvlN_ inputs of options.lvlfeats in options.lvlrange, and options.finalfeats.
+    Names in the set that are not in a given proc file (e.g. features made by create_new_base_features) are ignored
+    when used as usecols.
+
+    :param options: FeatureSetOptions options group
+    :param index_cols: List of columns to be treated as index columns.
+    :return: set of column names
+    """
+    cols = set(index_cols or [])
+    for q in options.filter_args.get('query_list', []):
+        for name in re.findall(r'[A-Za-z_][A-Za-z0-9_]*', q):
+            cols.add(name)
+            if name == '_continue':  # filter_df renames continue to _continue before querying
+                cols.add('continue')
+    cols.update(f'lvl{i}_{fn}' for fn in options.lvlfeats for i in options.lvlrange)
+    cols.update(options.finalfeats)
+    return cols
+
+
+def readProcCSV(f, index_cols, chunksize=None, usecols=None, compact=False):
+    """
+
+    :param f: path or file object of a proc data csv
+    :param index_cols: List of columns to be treated as index columns.
+    :param chunksize: if given along with compact, parse chunksize rows at a time and downcast each chunk before it
+    is kept, so the full size frame is never held. Ignored without compact: keeping full size chunks and concatenating
+    them would hold the frame twice, so the file is parsed in one call.
+    :param usecols: if given, collection of column names to read. Other columns are skipped by the parser.
+    :param compact: if True, downcast columns with compact_dtypes.
+    :return: dataframe
+    """
+    read_kwargs = {}
+    if usecols is not None:
+        read_kwargs['usecols'] = lambda c: c in usecols
+    if not (chunksize and compact):
+        df = pd.read_csv(f, index_col=index_cols, comment='#', **read_kwargs)
+    else:
+        with pd.read_csv(f, index_col=index_cols, comment='#', chunksize=chunksize, **read_kwargs) as reader:
+            df = pd.concat([compact_dtypes(chunk) for chunk in reader])
+    return compact_dtypes(df) if compact else df
+
+
+def readZipMembers(zf, index_cols, all_members=False, chunksize=None, usecols=None, compact=False):
+    """
+
+    :param zf: zipfile object
+    :param index_cols: List of columns to be treated as index columns.
+    :param all_members: if True, read every csv in the zip. Otherwise only the first file (default False).
+    :param chunksize: if given (with compact), parse chunksize rows at a time, see readProcCSV.
+    :param usecols: if given, collection of column names to read.
+    :param compact: if True, downcast columns with compact_dtypes.
+    :return: dataframe
+    """
+    if all_members:
+        members = [name for name in zf.namelist() if name.lower().endswith('.csv')]
+    else:
+        members = zf.namelist()[:1]
+    dfs = []
+    for member in members:
+        with zf.open(member) as f:
+            dfs.append(readProcCSV(f, index_cols, chunksize=chunksize, usecols=usecols, compact=compact))
+    if len(dfs) == 1:
+        return dfs[0]
+    df = pd.concat(dfs, sort=True)
+    return compact_dtypes(df) if compact else df
+
+
+def readCSVFromPath(path, index_cols, stream=False, usecols=None, compact=False):
     """
 
     :param path: path pointing to a csv
+    :param stream: if True and compact, parse the csv in compacted chunks of STREAM_CHUNKSIZE rows (see readProcCSV).
+    :param usecols: if given, collection of column names to read.
+    :param compact: if True, downcast columns with compact_dtypes.
     :return: dataframe, List[str] of metadata lines
     """
     import os
     print(os.getcwd())
     metadata = [f'Import from f{path}']
-    df = pd.read_csv(path, index_col=index_cols, comment='#')
+    df = readProcCSV(path, index_cols, chunksize=STREAM_CHUNKSIZE if stream else None, usecols=usecols,
+                     compact=compact)
     return df, metadata
 
 
-def getZippedLogDFbyURL(proc_zip_urls, index_cols=['sessionID']):
+def readZipFromURL(url, index_cols, stream=False, all_members=False, usecols=None, compact=False):
+    """
+
+    :param url: url pointing to a proc data file zip
+    :param index_cols: List of columns to be treated as index columns.
+    :param stream: if True, spool the download to a temp file instead of memory. With compact, also parse in
+    compacted chunks of STREAM_CHUNKSIZE rows (see readProcCSV).
+    :param all_members: if True, read every csv in the zip. Otherwise only the first file (default False).
+    :param usecols: if given, collection of column names to read.
+    :param compact: if True, downcast columns with compact_dtypes.
+    :return: dataframe, List[str] of metadata lines
+    """
+    zf, metadata = openZipFromURL(url, spool=stream)
+    source_file = zf.fp  # the spooled temp file or in memory buffer, which closing zf leaves open
+    try:
+        with zf:
+            df = readZipMembers(zf, index_cols, all_members=all_members,
+                                chunksize=STREAM_CHUNKSIZE if stream else None, usecols=usecols, compact=compact)
+    finally:
+        source_file.close()
+    return df, metadata
+
+
+def readZipFromPath(path, index_cols, stream=False, all_members=False, usecols=None, compact=False):
+    """
+
+    :param path: path pointing to a proc data file zip
+    :param index_cols: List of columns to be treated as index columns.
+    :param stream: if True and compact, parse in compacted chunks of STREAM_CHUNKSIZE rows (see readProcCSV).
+    :param all_members: if True, read every csv in the zip. Otherwise only the first file (default False).
+    :param usecols: if given, collection of column names to read.
+    :param compact: if True, downcast columns with compact_dtypes.
+    :return: dataframe, List[str] of metadata lines
+    """
+    zf, metadata = openZipFromPath(path)
+    with zf:
+        df = readZipMembers(zf, index_cols, all_members=all_members,
+                            chunksize=STREAM_CHUNKSIZE if stream else None, usecols=usecols, compact=compact)
+    return df, metadata
+
+
+PROC_CACHE_MAX_BYTES = 20 * 1024 ** 3  # total size of a proc cache dir before the least recently used files are evicted
+
+
+def get_cache_path(cache_dir, source, read_func, **read_kwargs):
+    """
+    Gets the cache file path for source read with read_func(source, **read_kwargs). The key covers the source path or
+    url, the file's mtime and size (local files only, the OGD export urls are versioned by name), and every read arg
+    that changes the resulting df.
+
+    :param cache_dir: directory of cached proc files
+    :param source: path or url of a proc data file
+    :param read_func: function used to read source
+    :return: path of the .feather cache file (which may not exist yet)
+    """
+    if os.path.exists(source):
+        stat = os.stat(source)
+        source_key = (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+    else:
+        source_key = (source,)
+    read_kwargs = {k: sorted(v) if isinstance(v, (set, frozenset)) else v
+                   for k, v in read_kwargs.items() if k != 'stream'}  # stream doesn't change the df
+    key = repr((source_key, read_func.__name__, sorted(read_kwargs.items())))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.feather')
+
+
+def readProcFileCached(source, read_func, cache_dir, **kwargs):
+    """
+    Wraps read_func with a columnar on-disk cache. On a miss the df and its metadata are written to an uncompressed
+    feather file in cache_dir. On a hit the feather file is memory mapped back.
+
+    :param source: path or url of a proc data file
+    :param read_func: module level function returning (df, metadata List[str]) for one source
+    :param cache_dir: directory of cached proc files
+    :return: (df, metadata List[str])
+    """
+    cache_path = get_cache_path(cache_dir, source, read_func, **kwargs)
+    if os.path.exists(cache_path):
+        os.utime(cache_path)  # mark as recently used for evict_proc_cache
+        return utils.read_columnar_with_meta(cache_path, memory_map=True)
+    df, metadata = read_func(source, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename, so other processes never see a partial cache file
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    utils.write_columnar_with_meta(df, tmp_path, metadata, compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+    return df, metadata
+
+
+def evict_proc_cache(cache_dir, max_bytes=PROC_CACHE_MAX_BYTES):
+    """
+    Deletes the least recently used cache files until cache_dir holds at most max_bytes.
+
+    :param cache_dir: directory of cached proc files
+    :param max_bytes: max total size of the cache files
+    :return: List[str] of deleted paths
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.feather'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    deleted = []
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+        deleted.append(path)
+    return deleted
+
+
+def readProcFiles(read_func, sources, workers=None, **kwargs):
+    """
+    Calls read_func(source, **kwargs) for each source. With workers > 1 the files are decompressed and parsed in a
+    process pool. Results always come back in the order of sources.
+
+    :param read_func: module level function returning (df, metadata List[str]) for one source
+    :param sources: List of paths or urls
+    :param workers: number of processes to use (None or 1 reads serially in this process)
+    :return: List[(df, metadata List[str])]
+    """
+    if not workers or workers <= 1 or len(sources) <= 1:
+        return [read_func(source, **kwargs) for source in sources]
+    with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as executor:
+        return list(executor.map(partial(read_func, **kwargs), sources))
+
+
+def getZippedLogDFbyURL(proc_zip_urls, index_cols=['sessionID'], workers=None, stream=False, all_members=False,
+                        options=None, compact=False, cache_dir=None, cache_max_bytes=PROC_CACHE_MAX_BYTES):
     """
 
     :param proc_urls: List of urls to proc data file zips.
     :param index_cols: List of columns to be treated as index columns.
+    :param workers: number of processes to download and parse the zips with (default None, one at a time).
+    :param stream: if True, spool downloads to temp files instead of memory, and with compact parse them in compacted
+    chunks (default False).
+    :param all_members: if True, read every csv in each zip. Otherwise only the first file (default False).
+    :param options: if given, FeatureSetOptions group. Only the columns full_filter needs for it are read.
+    :param compact: if True, downcast columns to float32/small ints/category as they are read (default False).
+    :param cache_dir: if given, parsed zips are cached as feather files in cache_dir and memory mapped on later loads.
+    :param cache_max_bytes: total size of cache_dir before least recently used files are evicted.
     :return: (df, metadata List[str])
     """
     # get the data
+    usecols = frozenset(get_options_columns(options, index_cols)) if options else None
+    read_func = readZipFromURL
+    if cache_dir:
+        read_func = partial(readProcFileCached, read_func=read_func, cache_dir=cache_dir)
     metadata = []
-    df = pd.DataFrame()
-    for next_url in proc_zip_urls:
-        zf, meta = openZipFromURL(next_url)
-        # put the data into a dataframe
-        with zf.open(zf.namelist()[0]) as f:
-            df = pd.concat(
-                [df, pd.read_csv(f, index_col=index_cols, comment='#')], sort=True)
+    dfs = []
+    for df, meta in readProcFiles(read_func, proc_zip_urls, workers=workers, index_cols=index_cols,
+                                  stream=stream, all_members=all_members, usecols=usecols, compact=compact):
+        dfs.append(df)
         metadata.extend(meta)
-    if len(index_cols) > 1:
-        for i, col_name in enumerate(index_cols):
-            df[col_name] = [x[i] for x in df.index]
-    else:
-        df[index_cols[0]] = [x for x in df.index]
+    if cache_dir:
+        evict_proc_cache(cache_dir, max_bytes=cache_max_bytes)
+    df = concatLogDFs(dfs, index_cols, compact=compact)
     return df, metadata
 
 
-def getLogDFbyPath(proc_paths, zipped=True, index_cols=['sessionID']):
+def getLogDFbyPath(proc_paths, zipped=True, index_cols=['sessionID'], workers=None, stream=False, all_members=False,
+                   options=None, compact=False, cache_dir=None, cache_max_bytes=PROC_CACHE_MAX_BYTES):
     """
 
     :param proc_paths: List of paths to proc data files.
     :param zipped: True if files are zipped, false if just CSVs (default True).
     :param index_cols: List of columns to be treated as index columns.
+    :param workers: number of processes to decompress and parse the files with (default None, one at a time).
+    :param stream: if True and compact, parse the files in compacted chunks so the uncompacted frame is never held
+    in memory (default False). Without compact it has no effect.
+    :param all_members: if True, read every csv in each zip. Otherwise only the first file (default False).
+    :param options: if given, FeatureSetOptions group. Only the columns full_filter needs for it are read.
+    :param compact: if True, downcast columns to float32/small ints/category as they are read (default False).
+    :param cache_dir: if given, parsed files are cached as feather files in cache_dir and memory mapped on later loads.
+    :param cache_max_bytes: total size of cache_dir before least recently used files are evicted.
     :return: (df, metadata List[str])
     """
     # get the data
+    usecols = frozenset(get_options_columns(options, index_cols)) if options else None
+    if zipped:
+        read_func = readZipFromPath
+        read_kwargs = {'all_members': all_members}
+    else:
+        read_func = readCSVFromPath
+        read_kwargs = {}
+    if cache_dir:
+        read_func = partial(readProcFileCached, read_func=read_func, cache_dir=cache_dir)
     metadata = []
-    df = pd.DataFrame()
-    for next_path in proc_paths:
-        if zipped:
-            next_file, meta = openZipFromPath(next_path)
-            # put the data into a dataframe
-            with next_file.open(next_file.namelist()[0]) as f:
-                df = pd.concat(
-                    [df, pd.read_csv(f, index_col=index_cols, comment='#')], sort=True)
-        else:  # CSVs, not zips
-            next_file, meta = readCSVFromPath(next_path, index_cols)
-            # put the data into a dataframe
-            df = pd.concat([df, next_file], sort=True)
+    dfs = []
+    for df, meta in readProcFiles(read_func, proc_paths, workers=workers, index_cols=index_cols, stream=stream,
+                                  usecols=usecols, compact=compact, **read_kwargs):
+        dfs.append(df)
         metadata.extend(meta)
-    if len(index_cols) > 1:
-        for i, col_name in enumerate(index_cols):
-            df[col_name] = [x[i] for x in df.index]
-    else:
-        df[index_cols[0]] = [x for x in df.index]
+    if cache_dir:
+        evict_proc_cache(cache_dir, max_bytes=cache_max_bytes)
+    df = concatLogDFs(dfs, index_cols, compact=compact)
     return df, metadata
 
+
+def concatLogDFs(dfs, index_cols, compact=False):
+    """
+    Combines the per-file proc dataframes with a single concat (growing the df one file at a time is quadratic in the
+    number of files), then copies the index columns back into the df as regular columns.
+
+    :param dfs: List of dataframes read from proc data files, in import order.
+    :param index_cols: List of columns to be treated as index columns.
+    :param compact: if True, run compact_dtypes on the combined df (category columns from different files concat
+    to object, so they are re-categorized here).
+    :return: df
+    """
+    df = pd.concat(dfs, sort=True) if dfs else pd.DataFrame()
+    if compact and len(dfs) > 1:
+        df = compact_dtypes(df)
+    # get_level_values works for both a plain index (level 0) and a MultiIndex, without building a python tuple per row
+    for i, col_name in enumerate(index_cols):
+        df[col_name] = df.index.get_level_values(i).to_numpy()
+    return df
+
 # consider making a general version with parameter for filename, index columns
 # def getLakelandDecJanLogDF():
 #     """
@@ -236,8 +523,39 @@ def get_lakeland_default_filter(lvlstart: Optional[int] = None, lvlend: Optional
     return query_list
 
 
+def query_mask(df: pd.DataFrame, q: str) -> np.ndarray:
+    """
+    Evaluates a df.query string into a boolean mask over the rows of df, without copying df.
+
+    :param df: dataframe to evaluate the query on
+    :param q: query string, as passed to df.query
+    :return: boolean numpy array with one entry per row
+    """
+    return np.asarray(df.eval(q), dtype=bool)
+
+
+def cumulative_query_masks(df: pd.DataFrame, query_list: List[str], precomputed_masks: Optional[dict] = None):
+    """
+    Evaluates every query in query_list once against the full df and ANDs them together in order.
+    The number of True values in each yielded mask is the row count df.query would give after that step.
+
+    :param df: dataframe to evaluate the queries on
+    :param query_list: list of query strings
+    :param precomputed_masks: optional dict of query string -> boolean mask over the rows of df. Queries found here are
+    not re-evaluated.
+    :return: generator of (query, cumulative boolean mask)
+    """
+    precomputed_masks = precomputed_masks or {}
+    mask = np.ones(len(df), dtype=bool)
+    for q in query_list:
+        q_mask = precomputed_masks[q] if q in precomputed_masks else query_mask(df, q)
+        mask = mask & q_mask
+        yield q, mask
+
+
 # split out query creation per-game
-def filter_df(df: pd.DataFrame, query_list: List[str], one_query: bool = False, fillna: object = 0, verbose: bool = True) -> (pd.DataFrame, List[str]):
+def filter_df(df: pd.DataFrame, query_list: List[str], one_query: bool = False, fillna: object = 0, verbose: bool = True,
+              precomputed_masks: Optional[dict] = None) -> (pd.DataFrame, List[str]):
     """
 
     :param df: dataframe to filter
@@ -245,11 +563,14 @@ def filter_df(df: pd.DataFrame, query_list: List[str], one_query: bool = False,
     :param one_query: bool to do the query (faster) as one query or seperate queries (slower, gives more info)
     :param fillna: value to fill NaNs with
     :param verbose: whether to input information
+    :param precomputed_masks: optional dict of query -> boolean mask over the rows of df, reused instead of
+    re-evaluating those queries (ignored if one_query). Not included in the meta.
     :return: (df, List[str])
     """
     df = df.rename({'continue': '_continue'}, axis=1)
     filter_args = locals()
     filter_args.pop('df')
+    filter_args.pop('precomputed_masks')
     filter_meta = [f'*arg* filter_args = {filter_args}']
 
     def append_meta_str(q, shape):
@@ -260,15 +581,18 @@ def filter_df(df: pd.DataFrame, query_list: List[str], one_query: bool = False,
 
     append_meta_str('Intial Shape', df.shape)
 
+    # each query becomes a boolean mask over the full df, and df is only copied once with the final mask
+    num_cols = df.shape[1]
+    mask = np.ones(len(df), dtype=bool)
     if not one_query:
-        for q in query_list:
-            df = df.query(q)
-            append_meta_str(q, df.shape)
+        for q, mask in cumulative_query_masks(df, query_list, precomputed_masks=precomputed_masks):
+            append_meta_str(q, (int(mask.sum()), num_cols))
     else:  # do the whole query at once
         full_query = ' & '.join([f"({q})" for q in query_list])
         print('full_query:', full_query)
-        df = df.query(full_query)
-        append_meta_str(full_query, df.shape)
+        mask = query_mask(df, full_query)
+        append_meta_str(full_query, (int(mask.sum()), num_cols))
+    df = df[mask]
 
     if fillna is not None:
         df = df.fillna(fillna)
@@ -323,13 +647,94 @@ def create_new_base_features(df, verbose=False):
 #     return df, metadata
 
 
+RANGE_STATS = ['sum', 'avg', 'min', 'max', 'std', 'nnz', 'first_nz', 'last_nz']
+DEFAULT_RANGE_STATS = ['sum', 'avg']
+
+
+def aggregate_range_block(df, prefix, fbase_list, rang, stats=DEFAULT_RANGE_STATS):
+    """
+    Calculates stats over rang of each feature base in fbase_list from one (rows x features x range values) block,
+    instead of slicing and aggregating one feature base at a time. Every stat is reduced from the same block.
+    NaNs count as 0, like fillna(0) before aggregating.
+
+    Stats (column names are {stat}_{prefix}_A_to_B_{fn}):
+        sum, avg, min, max, std (sample std, like DataFrame.std; NaN for a single value range),
+        nnz (number of nonzero values), first_nz/last_nz (first/last range value with a nonzero value, NaN if none)
+
+    :param df: dataframe to pull from
+    :param prefix: range prefix, e.g. 'lvl', 'obj', 'int', 'Q'
+    :param fbase_list: list of feature bases (fnames without {prefix}N_ prefix)
+    :param rang: range of values to aggregate over. typically range(min_val, max_val+1)
+    :param stats: list of stats from RANGE_STATS (default sum and avg)
+    :return: dataframe (same index as df) of the new columns, ordered by feature base then stat
+    """
+    unknown_stats = [stat for stat in stats if stat not in RANGE_STATS]
+    if unknown_stats:
+        raise ValueError(f'Unknown range stats {unknown_stats}. Choose from {RANGE_STATS}.')
+    fromval, toval = rang[0], rang[-1]
+    num_vals = len(rang)
+    source_cols = [f'{prefix}{i}_{fn}' for fn in fbase_list for i in rang]
+    source_df = df[source_cols]
+    # (rows, features, range values) view of a single float copy of the source columns
+    block = source_df.to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    block = block.reshape(len(df), len(fbase_list), num_vals)
+    np.nan_to_num(block, copy=False, nan=0.0)
+    # sum/min/max of all-integer columns stay integers, as they did with the per-feature DataFrame.sum
+    int_feats = np.array([pd.api.types.is_integer_dtype(dtype) for dtype in source_df.dtypes]).reshape(
+        len(fbase_list), num_vals).all(axis=1)
+
+    results = {}
+    if 'sum' in stats or 'avg' in stats:
+        results['sum'] = block.sum(axis=2)
+        results['avg'] = results['sum'] / num_vals
+    if 'min' in stats:
+        results['min'] = block.min(axis=2)
+    if 'max' in stats:
+        results['max'] = block.max(axis=2)
+    if 'std' in stats:
+        results['std'] = block.std(axis=2, ddof=1) if num_vals > 1 else np.full(block.shape[:2], np.nan)
+    if {'nnz', 'first_nz', 'last_nz'}.intersection(stats):
+        nonzero = block != 0
+        results['nnz'] = nonzero.sum(axis=2)
+        any_nonzero = nonzero.any(axis=2)
+        range_vals = np.asarray(rang, dtype=np.float64)
+        results['first_nz'] = np.where(any_nonzero, range_vals[nonzero.argmax(axis=2)], np.nan)
+        results['last_nz'] = np.where(any_nonzero, range_vals[num_vals - 1 - nonzero[:, :, ::-1].argmax(axis=2)],
+                                      np.nan)
+
+    new_cols = {}
+    for j, fn in enumerate(fbase_list):
+        for stat in stats:
+            values = results[stat][:, j]
+            if stat == 'nnz' or (stat in ['sum', 'min', 'max'] and int_feats[j]):
+                values = values.astype(np.int64)
+            new_cols[f'{stat}_{prefix}_{fromval}_to_{toval}_{fn}'] = values
+    return pd.DataFrame(new_cols, index=df.index)
+
+
+def add_columns(df, new_df):
+    """
+    Attaches all columns of new_df to df with a single concat instead of inserting them one at a time. Columns of df
+    with the same names are replaced where they are, other new columns go at the end. df itself is not modified.
+
+    :param df: dataframe to add the columns to
+    :param new_df: dataframe of new columns with the same index as df
+    :return: new dataframe with df's columns and the new columns
+    """
+    existing_cols = [c for c in new_df.columns if c in df.columns]
+    if not existing_cols:
+        return pd.concat([df, new_df], axis=1)
+    col_order = list(df.columns) + [c for c in new_df.columns if c not in df.columns]
+    return pd.concat([df.drop(columns=existing_cols), new_df], axis=1)[col_order]
+
+
 def describe_lvl_feats(df, fbase_list, lvl_range):
     """
     Calculates sum/avg of given level base features (fnames without lvlN_ prefix) in the level range.
     May have a bug.
 
-    :rtype: (df, List[str]) where the new df includes sum_ and avg_lvl_A_to_B
-    :param df: dataframe to pull from and append to
+    :rtype: (df, List[str]) where the new df is a copy of df that also includes sum_ and avg_lvl_A_to_B
+    :param df: dataframe to pull from. Not modified, the new columns are added to the returned copy (see add_columns).
     :param fbase_list: list of feature bases (fnames without lvlN_ prefix)
     :param lvl_range: range of levels to choose. typically range(min_level, max_level+1)
     """
@@ -345,29 +750,27 @@ def describe_lvl_feats(df, fbase_list, lvl_range):
     # metadata.append(
     #     f'Describe Level Feats lvls {lvl_start} to {lvl_end}. Assuming WINDOW_SIZE_SECONDS={level_time} and WINDOW_OVERLAP_SECONDS={level_overlap}, filtered by ({query})')
 
-    fromlvl, tolvl = lvl_range[0], lvl_range[-1]
-    sum_prefix = f'sum_lvl_{fromlvl}_to_{tolvl}_'
-    avg_prefix = f'avg_lvl_{fromlvl}_to_{tolvl}_'
-    for fn in fbase_list:
-        tdf = df[[f'lvl{i}_{fn}' for i in lvl_range]].fillna(0)
-        df[sum_prefix + fn] = tdf.sum(axis=1)
-        df[avg_prefix + fn] = tdf.mean(axis=1)
+    df = add_columns(df, aggregate_range_block(df, 'lvl', fbase_list, lvl_range))
     return df, metadata
 
 
-def describe_range_feats(df, range_feats_and_range, cc_prefix_max_list):
+def describe_range_feats(df, range_feats_and_range, cc_prefix_max_list, stats=DEFAULT_RANGE_STATS):
     """
     Calculates sum/avg of given level base features (fnames without lvlN_ prefix) in the level range.
     May have a bug.
 
-    :rtype: (df, List[str]) where the new df includes sum_ and avg_lvl_A_to_B
-    :param df: dataframe to pull from and append to
+    :rtype: (df, List[str]) where the new df is a copy of df that also includes sum_ and avg_lvl_A_to_B
+    :param df: dataframe to pull from. Not modified, the new columns are added to the returned copy (see add_columns).
     :param fbase_list: list of feature bases (fnames without lvlN_ prefix)
     :param lvl_range: range of levels to choose. typically range(min_level, max_level+1)
+    :param stats: list of stats from RANGE_STATS to calculate for every range (default sum and avg).
+    See aggregate_range_block.
     """
     metadata = []
     metadata.append(f'*arg* range_feats_and_range = {range_feats_and_range}')
     metadata.append(f'*arg* cc_prefix_max_list = {cc_prefix_max_list}')
+    if list(stats) != DEFAULT_RANGE_STATS:
+        metadata.append(f'Range stats: {list(stats)}')
     if not range_feats_and_range:
         return df, metadata
 
@@ -378,16 +781,14 @@ def describe_range_feats(df, range_feats_and_range, cc_prefix_max_list):
     #     f'Describe Level Feats lvls {lvl_start} to {lvl_end}. Assuming WINDOW_SIZE_SECONDS={level_time} and WINDOW_OVERLAP_SECONDS={level_overlap}, filtered by ({query})')
 
     range_prefix_max_list = [('lvl', None)]+cc_prefix_max_list
+    new_dfs = []
     for i in range(len(range_feats_and_range)):
         range_feats, rang = range_feats_and_range[i]
         prefix, _ = range_prefix_max_list[i]
-        fromval, toval = rang[0], rang[-1]
-        sum_prefix = f'sum_{prefix}_{fromval}_to_{toval}_'
-        avg_prefix = f'avg_{prefix}_{fromval}_to_{toval}_'
-        for fn in range_feats:
-            tdf = df[[f'{prefix}{i}_{fn}' for i in rang]].fillna(0)
-            df[sum_prefix + fn] = tdf.sum(axis=1)
-            df[avg_prefix + fn] = tdf.mean(axis=1)
+        if range_feats:
+            new_dfs.append(aggregate_range_block(df, prefix, range_feats, rang, stats=stats))
+    if new_dfs:
+        df = add_columns(df, pd.concat(new_dfs, axis=1))
     return df, metadata
 
 
@@ -593,51 +994,157 @@ def reduce_feats(df, featlist):
     return df[featlist].copy(), [f'*arg* finalfeats = {featlist}']
 
 
-def reduce_outliers(df, z_thresh, show_graphs=True, outpath=None):
+OUTLIER_CHUNK_ROWS = 20000  # rows per block when computing outlier zscores
+MAD_TO_STD = 1.4826  # scales the median absolute deviation to the std of a normal distribution
+MEANAD_TO_STD = 1.2533  # scales the mean absolute deviation to the std of a normal distribution
+
+
+def column_centers_and_scales(df, method='zscore', chunk_rows=OUTLIER_CHUNK_ROWS):
+    """
+    Gets per-column centers and scales for zscores, ignoring NaNs.
+    'zscore' uses the mean and (population) std, computed in one pass over blocks of chunk_rows rows.
+    'robust' uses the median and the MAD scaled to a std, computed one column at a time. Columns with a MAD of 0
+    (e.g. mostly 0 counts) fall back to the scaled mean absolute deviation from the median.
+
+    :param df: numeric dataframe
+    :param method: 'zscore' or 'robust'
+    :param chunk_rows: number of rows per block
+    :return: (centers, scales) numpy arrays with one value per column
+    """
+    num_cols = df.shape[1]
+    if method == 'zscore':
+        # Chan et al. pairwise update of the running count, mean and sum of squared differences
+        count = np.zeros(num_cols)
+        mean = np.zeros(num_cols)
+        m2 = np.zeros(num_cols)
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows].to_numpy(dtype=np.float64, na_value=np.nan)
+            chunk_count = (~np.isnan(chunk)).sum(axis=0)
+            has_values = chunk_count > 0
+            chunk_mean = np.zeros(num_cols)
+            chunk_mean[has_values] = np.nansum(chunk[:, has_values], axis=0) / chunk_count[has_values]
+            chunk_m2 = np.nansum((chunk - chunk_mean) ** 2, axis=0)
+            new_count = count + chunk_count
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = chunk_mean - mean
+                mean = np.where(has_values, mean + delta * chunk_count / new_count, mean)
+                m2 = np.where(has_values, m2 + chunk_m2 + delta ** 2 * count * chunk_count / new_count, m2)
+            count = new_count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, mean, np.nan), np.sqrt(m2 / count)
+    elif method == 'robust':
+        centers = np.full(num_cols, np.nan)
+        scales = np.full(num_cols, np.nan)
+        for j in range(num_cols):
+            values = df.iloc[:, j].to_numpy(dtype=np.float64, na_value=np.nan)
+            values = values[~np.isnan(values)]
+            if not len(values):
+                continue
+            centers[j] = np.median(values)
+            abs_dev = np.abs(values - centers[j])
+            scales[j] = np.median(abs_dev) * MAD_TO_STD
+            if scales[j] == 0:
+                scales[j] = abs_dev.mean() * MEANAD_TO_STD
+        return centers, scales
+    raise ValueError(f"Unknown outlier method {method}. Use 'zscore' or 'robust'.")
+
+
+def outlier_keep_mask(df, z_thresh, method='zscore', chunk_rows=OUTLIER_CHUNK_ROWS):
+    """
+    Gets a mask of the rows of df with abs(zscore) < threshold in every column.
+    NaNs never mark a row as an outlier, and constant columns (scale 0) are not filtered on.
+    Only blocks of chunk_rows rows are converted to zscores at a time, so memory stays bounded on wide frames.
+
+    :param df: numeric dataframe
+    :param z_thresh: zscore threshold, or dict of column -> threshold (columns not in the dict are not filtered on)
+    :param method: 'zscore' (mean/std) or 'robust' (median/MAD). See column_centers_and_scales.
+    :param chunk_rows: number of rows per block
+    :return: boolean numpy array with one entry per row
+    """
+    if isinstance(z_thresh, dict):
+        thresholds = np.array([z_thresh.get(col, np.inf) for col in df.columns], dtype=np.float64)
+    else:
+        thresholds = np.full(df.shape[1], z_thresh, dtype=np.float64)
+    centers, scales = column_centers_and_scales(df, method=method, chunk_rows=chunk_rows)
+    # don't filter on constant or empty columns
+    thresholds[~(scales > 0)] = np.inf
+    scales = np.where(scales > 0, scales, 1)
+    keep = np.ones(len(df), dtype=bool)
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].to_numpy(dtype=np.float64, na_value=np.nan)
+        z = np.abs(chunk - centers) / scales
+        keep[start:start + chunk_rows] = ~(z >= thresholds).any(axis=1)  # NaN >= thresh is False, so NaNs are kept
+    return keep
+
+
+def save_boxplot(df, title, savepath, plot_executor=None):
+    """
+    Saves a box plot of every column of df. The plot is always rendered on the calling thread, since matplotlib isn't
+    thread safe; with a plot_executor only the file write is done in the background.
+
+    :param df: dataframe to plot
+    :param title: plot title
+    :param savepath: path of the png to save
+    :param plot_executor: optional executor (anything with submit(fn, *args)) to write the png with
+    """
+    fig = Figure(figsize=(20, 5))
+    ax = fig.subplots()
+    df.plot(kind='box', title=title, ax=ax)
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png')
+    if plot_executor is not None:
+        plot_executor.submit(utils.write_bytes, buffer.getvalue(), savepath)
+    else:
+        utils.write_bytes(buffer.getvalue(), savepath)
+
+
+def reduce_outliers(df, z_thresh, show_graphs=True, outpath=None, method='zscore', chunk_rows=OUTLIER_CHUNK_ROWS,
+                    plot_executor=None):
     """
-    Takes in df and z_thresh, shows box plots, and outputs graph with points of zscore>z_thresh removed.
-    Does not always work properly. Does not seem to tolerate NaNs.
-    TODO: fix.
+    Takes in df and z_thresh, saves box plots, and outputs graph with points of zscore>z_thresh removed.
+    NaNs are ignored when computing zscores and never count as outliers.
     :param df:
-    :param z_thresh:
-    :param show_graphs:
+    :param z_thresh: zscore threshold, or dict of column -> threshold. None to skip removing outliers.
+    :param show_graphs: whether to draw the box plots. They are only drawn if there is also an outpath to save them to.
+    :param outpath: directory to save the box plots to
+    :param method: 'zscore' (mean/std) or 'robust' (median/MAD)
+    :param chunk_rows: number of rows converted to zscores at a time
+    :param plot_executor: optional executor (anything with submit(fn, *args)) to write the box plot pngs in the background
     :return:
     """
+    def boxplot(plot_df, title, fname):
+        if not (show_graphs and outpath):
+            return
+        save_boxplot(plot_df, title, os.path.join(outpath, fname), plot_executor)
+
     meta = []
     meta.append(f"Original Num Rows: {len(df)}")
     meta.append(f"*arg* zthresh = {z_thresh}")
-    title = f'Raw Boxplot Original Data n={len(df)}'
-    df.plot(kind='box', title=title, figsize=(20, 5))
-    if outpath:
-        savepath = os.path.join(outpath, f'Raw Boxplot Original.png')
-        plt.savefig(savepath)
-    plt.close()
+    boxplot(df, f'Raw Boxplot Original Data n={len(df)}', 'Raw Boxplot Original.png')
 
     if z_thresh is None:
         return df, meta
 
-    z = np.abs(stats.zscore(df))
-    no_outlier_df = df[(z < z_thresh).all(axis=1)]
+    no_outlier_df = df[outlier_keep_mask(df, z_thresh, method=method, chunk_rows=chunk_rows)]
+    score_name = 'ZScore' if method == 'zscore' else 'robust ZScore (median/MAD)'
     meta.append(
-        f'Removed points with abs(ZScore) >= {z_thresh}. Reduced num rows: {len(no_outlier_df)}')
-    title = f'Raw Boxplot ZThresh={z_thresh} n={len(no_outlier_df)}'
-    no_outlier_df.plot(kind='box', title=title, figsize=(20, 5))
-    if outpath:
-        savepath = os.path.join(outpath, f'Raw Boxplot Zthresh Removed.png')
-        plt.savefig(savepath)
-    plt.close()
+        f'Removed points with abs({score_name}) >= {z_thresh}. Reduced num rows: {len(no_outlier_df)}')
+    boxplot(no_outlier_df, f'Raw Boxplot ZThresh={z_thresh} n={len(no_outlier_df)}', 'Raw Boxplot Zthresh Removed.png')
     return no_outlier_df, meta
 
 
 jw_cc_max = [('obj', 80), ('int', 188), ('Q', 18)]
 
 
-def full_filter(df, import_meta, options, outpath) -> (pd.DataFrame, List[str]):
+def full_filter(df, import_meta, options, outpath, show_graphs=True, plot_executor=None, method='zscore') -> (pd.DataFrame, List[str]):
     """
     Takes in a df, metadata, and options group.
     Outputs the filtered df and the meta.
     :param get_df_func:
     :param options:
+    :param show_graphs: whether to save the outlier box plots to outpath
+    :param plot_executor: optional executor to write the outlier box plots in the background
+    :param method: outlier score, 'zscore' (mean/std) or 'robust' (median/MAD), see reduce_outliers
     :return:
     """
     # df, import_meta = get_df_func()
@@ -662,19 +1169,26 @@ def full_filter(df, import_meta, options, outpath) -> (pd.DataFrame, List[str]):
     # hack while NaNs are popping up in aggregate df or newfeatdf TODO: Fix this. It never used to be an issue.
     reduced_df = reduced_df.fillna(0)
     final_df, outlier_meta = reduce_outliers(
-        reduced_df, options.zthresh, outpath=outpath)
+        reduced_df, options.zthresh, show_graphs=show_graphs, outpath=outpath, method=method, plot_executor=plot_executor)
     final_meta = import_meta + filter_meta + new_feat_meta + \
         aggregate_meta + reduced_meta + outlier_meta
     return final_df, final_meta
 
 
 def save_csv_and_meta(df, meta_list, save_dir, csv_name, meta_name=None, permissions='w+', add_columns=True):
-    if csv_name.endswith(('.tsv', '.csv')):
-        extension = csv_name[-4:]
-        csv_name = csv_name[:-4]
+    """
+    Saves df with the meta list as a leading # comment block and as a _meta.txt file next to it.
+    If csv_name ends in .parquet or .feather, df is saved in that binary format instead, with the meta lines stored in
+    the file metadata. Names ending in .csv.gz/.tsv.gz are gzipped. Read any of these back with
+    open_df_from_path_with_meta.
+    """
+    if csv_name.endswith(('.csv.gz', '.tsv.gz')):
+        csv_name, extension = csv_name[:-7], csv_name[-7:]
+    elif csv_name.endswith(('.tsv', '.csv') + utils.COLUMNAR_EXTENSIONS):
+        csv_name, extension = os.path.splitext(csv_name)
     else:
         extension = '.csv'
-    separator = '\t' if extension == '.tsv' else ','
+    separator = '\t' if extension.startswith('.tsv') else ','
 
     # hardcopy
     meta_list = [x for x in meta_list]
@@ -687,7 +1201,13 @@ def save_csv_and_meta(df, meta_list, save_dir, csv_name, meta_name=None, permiss
     meta_name = meta_name or csv_name + '_meta.txt'
     meta_text = save_meta(meta_list, save_dir, meta_name, permissions=permissions)
 
-    with open(os.path.join(save_dir, csv_name)+extension, permissions) as f:
+    if extension in utils.COLUMNAR_EXTENSIONS:
+        # same lines open_csv_from_path_with_meta would parse out of the # comment block
+        utils.write_columnar_with_meta(df, os.path.join(save_dir, csv_name)+extension,
+                                       [l.strip() for l in meta_text.splitlines()])
+        return None, []
+
+    with utils.open_text(os.path.join(save_dir, csv_name)+extension, permissions) as f:
         for l in meta_text.splitlines():
             f.write(f'# {l}\n')
         f.write('\n')
@@ -705,16 +1225,40 @@ def save_meta(meta_list, save_dir, meta_name, permissions='w+'):
 
 
 def open_csv_from_path_with_meta(csv_fpath, index_col=0):
+    """
+    Reads the leading # meta lines of a csv, then hands the same file handle to pd.read_csv at the first data line,
+    so the file is only read once. Files ending in .gz are decompressed transparently.
+
+    :param csv_fpath: path to a csv saved with a # meta block (e.g. by save_csv_and_meta)
+    :param index_col: index column(s)
+    :return: (df, metadata List[str])
+    """
     metadata = []
-    with open(csv_fpath) as f:
-        for line in f.readlines():
+    with utils.open_text(csv_fpath) as f:
+        while True:
+            line_start = f.tell()
+            line = f.readline()
             if line.startswith('#'):
                 metadata.append(line[2:].strip())
             else:
                 break
-    df = pd.read_csv(csv_fpath, comment='#', index_col=index_col)
+        f.seek(line_start)
+        df = pd.read_csv(f, comment='#', index_col=index_col)
     return df, metadata
 
+
+def open_df_from_path_with_meta(fpath, index_col=0):
+    """
+    Opens a file saved by save_csv_and_meta, as csv/tsv or parquet/feather.
+
+    :param fpath: path to the saved file
+    :param index_col: index column(s) for csvs. parquet/feather files keep the index they were saved with.
+    :return: (df, metadata List[str])
+    """
+    if utils.is_columnar_path(fpath):
+        return utils.read_columnar_with_meta(fpath)
+    return open_csv_from_path_with_meta(fpath, index_col=index_col)
+
 def remove_nan_labels(X, y):
     nonnull_indices = ~y.isna()
     ret_X = X.loc[nonnull_indices, :].copy()
@@ -13,6 +13,10 @@ import pickle
 from math import ceil
 import importlib
 import urllib.request
+import hashlib
+import json
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 
 # math imports
 from matplotlib import pyplot as plt
@@ -651,7 +655,7 @@ class GridSearcher():
         # load df
         if df is None:
             print(f'Loading from {csv_fpath}...')
-            self.df, self.meta = feat_util.open_csv_from_path_with_meta(
+            self.df, self.meta = feat_util.open_df_from_path_with_meta(
                 csv_fpath, index_col=0)
         else:
             self.df, self.meta = df, meta
@@ -807,6 +811,140 @@ class GridSearcher():
         print(classification_report(y_true, y_pred))
 
 
+def sweep_grid(y_keys, samplers, classifiers):
+    """
+    :return: every (y_key, sampler, classifier) combination, for run_sweep
+    """
+    return list(product(y_keys, samplers, classifiers))
+
+
+def stable_key(obj):
+    """
+    Deterministic, json serializable description of a sweep setting, for checkpoint keys.
+    Estimators are described by their class and every (nested) param, unlike their repr, which leaves out default
+    params and truncates long pipelines. Dataframes and arrays are described by a hash of their contents.
+    """
+    if hasattr(obj, 'get_params'):
+        # recursing into get_params(deep=False) covers the same params as get_params(deep=True)
+        return [f'{type(obj).__module__}.{type(obj).__qualname__}',
+                {k: stable_key(v) for k, v in sorted(obj.get_params(deep=False).items())}]
+    if isinstance(obj, dict):
+        return {str(k): stable_key(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, (list, tuple)):
+        return [stable_key(v) for v in obj]
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        contents = pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes()
+        columns = list(map(str, obj.columns)) if isinstance(obj, pd.DataFrame) else str(obj.name)
+        return ['pandas', columns, hashlib.sha1(contents).hexdigest()]
+    if isinstance(obj, np.ndarray):
+        return ['ndarray', str(obj.dtype), list(obj.shape), hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()]
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if callable(obj):
+        return f'{getattr(obj, "__module__", "")}.{getattr(obj, "__qualname__", repr(obj))}'
+    return f'{type(obj).__qualname__}:{obj!r}'
+
+
+def sweep_settings_digest(searcher_kwargs, run_fit_kwargs=None):
+    """
+    :return: hash of the dataset/GridSearcher and run_fit settings a sweep was run with
+    """
+    csv_fpath = searcher_kwargs.get('csv_fpath')
+    # so a csv rewritten in place at the same path doesn't match its old checkpoints
+    csv_stat = [os.path.getsize(csv_fpath), os.path.getmtime(csv_fpath)] if csv_fpath and os.path.exists(csv_fpath) else None
+    key = json.dumps([stable_key(searcher_kwargs), csv_stat, stable_key(run_fit_kwargs or {})], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def sweep_checkpoint_path(checkpoint_dir, y_key, sampler, classifier, settings_digest):
+    """
+    :param settings_digest: sweep_settings_digest of the sweep, so checkpoints from another dataset or other run_fit
+    settings are never mistaken for this sweep's
+    """
+    key = json.dumps([settings_digest, stable_key(y_key), stable_key(sampler), stable_key(classifier)], sort_keys=True)
+    return os.path.join(checkpoint_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+# the GridSearcher of a sweep worker process, built once by _init_sweep_searcher
+_sweep_searcher = None
+
+
+def _init_sweep_searcher(searcher_kwargs):
+    global _sweep_searcher
+    _sweep_searcher = GridSearcher(**searcher_kwargs)
+
+
+def _run_sweep_combination(searcher, combination, checkpoint_dir=None, settings_digest=None, run_fit_kwargs=None):
+    y_key, sampler, classifier = combination
+    searcher.set_y(y_key)
+    # copies, so a combination that shares an estimator object with another never sees it fitted
+    searcher.run_fit(copy.deepcopy(classifier), sampler=copy.deepcopy(sampler), **(run_fit_kwargs or {}))
+    result = {'y_key': y_key, 'sampler': str(sampler), 'classifier': str(classifier),
+              'metrics': [[name, float(value)] for value, name in searcher.metrics()]}
+    if checkpoint_dir:
+        savepath = sweep_checkpoint_path(checkpoint_dir, y_key, sampler, classifier, settings_digest)
+        with open(savepath + '.tmp', 'w+') as f:
+            json.dump(result, f)
+        os.replace(savepath + '.tmp', savepath)  # so an interrupted write never leaves a partial checkpoint
+    return result
+
+
+def _run_sweep_combination_in_worker(*args):
+    return _run_sweep_combination(_sweep_searcher, *args)
+
+
+def run_sweep(combinations, searcher_kwargs, checkpoint_dir=None, workers=None, run_fit_kwargs=None, verbose=True):
+    """
+    Runs GridSearcher.run_fit and metrics() for every (y_key, sampler, classifier) combination.
+    Each combination's metrics are saved as json in checkpoint_dir, and combinations that already have a checkpoint
+    there are loaded instead of rerun, so an interrupted sweep picks up where it left off. Checkpoints are keyed on
+    the combination's full estimator params and on searcher_kwargs/run_fit_kwargs, so one checkpoint_dir can be
+    shared between sweeps of different datasets or settings.
+
+    :param combinations: list of (y_key, sampler, classifier), eg. from sweep_grid
+    :param searcher_kwargs: kwargs for GridSearcher (eg. dict(csv_fpath=...)). Each worker process builds its own.
+    :param checkpoint_dir: optional directory to checkpoint results in
+    :param workers: number of processes to fit combinations in (None or 1 runs serially in this process)
+    :param run_fit_kwargs: extra kwargs for GridSearcher.run_fit
+    :return: tidy df with columns y_key, sampler, classifier, metric, value (in the order of combinations)
+    """
+    results = {}
+    settings_digest = None
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        settings_digest = sweep_settings_digest(searcher_kwargs, run_fit_kwargs)
+        for i, (y_key, sampler, classifier) in enumerate(combinations):
+            savepath = sweep_checkpoint_path(checkpoint_dir, y_key, sampler, classifier, settings_digest)
+            if os.path.exists(savepath):
+                with open(savepath) as f:
+                    results[i] = json.load(f)
+    todo = [i for i in range(len(combinations)) if i not in results]
+    if verbose:
+        print(f'Sweep: {len(results)} of {len(combinations)} combinations already checkpointed, running {len(todo)}.')
+    if todo and (not workers or workers <= 1):
+        # a local searcher, so its df is freed when the sweep returns
+        searcher = GridSearcher(**searcher_kwargs)
+        for i in todo:
+            results[i] = _run_sweep_combination(searcher, combinations[i], checkpoint_dir, settings_digest,
+                                                run_fit_kwargs)
+    elif todo:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)), initializer=_init_sweep_searcher,
+                                 initargs=(searcher_kwargs,)) as executor:
+            futures = {i: executor.submit(_run_sweep_combination_in_worker, combinations[i], checkpoint_dir,
+                                          settings_digest, run_fit_kwargs)
+                       for i in todo}
+            for i, future in futures.items():
+                results[i] = future.result()
+    rows = []
+    for i in range(len(combinations)):
+        result = results[i]
+        rows.extend((result['y_key'], result['sampler'], result['classifier'], name, value)
+                    for name, value in result['metrics'])
+    return pd.DataFrame(rows, columns=['y_key', 'sampler', 'classifier', 'metric', 'value'])
+
+
 class JWWindowSelector:
 
     ycols = ['R0_quiz_response','R1_quiz_response','R2_quiz_response','R1_quiz_response_bin',
@@ -817,19 +955,28 @@ class JWWindowSelector:
     LEVEL = 1
     QUIZ = 2
     OBJECTIVE = 3
+    # filter queries that are the same for every window. Their masks are evaluated once per selector.
+    shared_queries = [f"R{i}_quiz_response == R{i}_quiz_response" for i in [0,1,2]]
 
     def __init__(self, csv_fpath=None, df=None, meta=None):
         assert csv_fpath is not None or df is not None
         # load df
         if df is None:
             print(f'Loading from {csv_fpath}...')
-            self.df, self.meta = feat_util.open_csv_from_path_with_meta(
+            self.df, self.meta = feat_util.open_df_from_path_with_meta(
                 csv_fpath, index_col=0)
         else:
             self.df = df
             self.meta = meta or []
 
         self.df_cols = list(df.columns)
+        self._shared_masks = None
+
+    def get_shared_masks(self):
+        # dict of shared query -> boolean mask over the rows of self.df, evaluated on first use
+        if self._shared_masks is None:
+            self._shared_masks = {q: feat_util.query_mask(self.df, q) for q in JWWindowSelector.shared_queries}
+        return self._shared_masks
 
     @staticmethod
     def get_abbrev(window_type):
@@ -904,7 +1051,7 @@ class JWWindowSelector:
             queries.append(f"{prefix}time_in_level < 1200")
             queries.append(f"{prefix}time_in_level > 0")
 
-        queries.extend([f"R{i}_quiz_response == R{i}_quiz_response" for i in [0,1,2]])
+        queries.extend(JWWindowSelector.shared_queries)
         return queries
 
     def get_base_meta(self):
@@ -927,7 +1074,8 @@ class JWWindowSelector:
             elif total_words < 10:
                 print('Total words < 10!')
         queries = self.get_filter_queries(n, window_type, max_seconds_per_word=max_seconds_per_word)
-        filtered_df, filtered_df_meta = feat_util.filter_df(self.df[Xfeats+JWWindowSelector.ycols], query_list=queries, verbose=True, fillna=None)
+        filtered_df, filtered_df_meta = feat_util.filter_df(self.df[Xfeats+JWWindowSelector.ycols], query_list=queries, verbose=True, fillna=None,
+                                                            precomputed_masks=self.get_shared_masks())
         meta.extend(filtered_df_meta)
         X = filtered_df[Xfeats].fillna(0).copy()
         meta.append(f'Filled X with 0')
@@ -0,0 +1,45 @@
+"""
+Regression tests for feature_utils.
+
+Usage:
+python -m pytest test_feature_utils.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_utils as feat_util
+
+
+def _old_concatLogDFs(dfs, index_cols):
+    # the loader's index column restoration before it used get_level_values
+    df = pd.concat(dfs, sort=True)
+    if len(index_cols) > 1:
+        for i, col_name in enumerate(index_cols):
+            df[col_name] = [x[i] for x in df.index]
+    else:
+        df[index_cols[0]] = [x for x in df.index]
+    return df
+
+
+def _make_proc_dfs(index_cols, num_files=3, num_rows=50, seed=0):
+    rng = np.random.default_rng(seed)
+    dfs = []
+    for f in range(num_files):
+        df = pd.DataFrame({'lvl0_feat': rng.poisson(3, num_rows),
+                           'lvl1_feat': rng.normal(size=num_rows),
+                           'persistentSessionID': [f'p{i % 7}' for i in range(num_rows)],
+                           'sessID': np.arange(num_rows) + f * num_rows,
+                           'num_play': rng.integers(0, 3, num_rows)})
+        dfs.append(df.set_index(index_cols))
+    return dfs
+
+
+@pytest.mark.parametrize('index_cols', [['sessID'], ['sessID', 'num_play']])
+def test_concatLogDFs_matches_list_comprehension(index_cols):
+    dfs = _make_proc_dfs(index_cols)
+    expected = _old_concatLogDFs([df.copy() for df in dfs], index_cols)
+    result = feat_util.concatLogDFs([df.copy() for df in dfs], index_cols)
+    assert list(result.columns) == list(expected.columns)
+    assert result.dtypes.equals(expected.dtypes)
+    pd.testing.assert_frame_equal(result, expected)
@@ -46,6 +46,9 @@ else:
   print(f'Not saving.')
 """
 
+import gzip
+import json
+
 TEST_STR = 'hello'
 
 
@@ -124,13 +127,88 @@ display(folder_selector, file_selector)
 """
 
 
+COLUMNAR_META_KEY = b'ogd_meta'  # key of the meta strings in a parquet/feather file's key/value metadata
+COLUMNAR_EXTENSIONS = ('.parquet', '.feather')
+
+
+def is_columnar_path(path):
+    return str(path).endswith(COLUMNAR_EXTENSIONS)
+
+
+def open_text(path, mode='r'):
+    """
+    Opens a text file, transparently (de)compressing it if the path ends in .gz.
+
+    :param path: file path
+    :param mode: open mode, e.g. 'r', 'w+'
+    :return: text file object
+    """
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode.replace('+', '').replace('t', '') + 't')
+    return open(path, mode)
+
+
+def write_bytes(data, path):
+    with open(path, 'wb+') as f:
+        f.write(data)
+
+
 def write_csv_with_meta(df, path, meta_strings, mode='w+'):
-    with open(path, mode=mode) as f:
+    # .parquet/.feather paths are written in that format, with meta_strings in the file metadata
+    if is_columnar_path(path):
+        write_columnar_with_meta(df, path, meta_strings)
+        return
+    with open_text(path, mode=mode) as f:
         for l in meta_strings:
             f.write(f'# {l}\n')
         df.to_csv(f)
 
 
+def write_columnar_with_meta(df, path, meta_strings, compression=None):
+    """
+    Writes df (with its index) to a .parquet or .feather file, storing meta_strings in the file level metadata.
+    Needs pyarrow.
+
+    :param df: dataframe to write. Column names must be strings.
+    :param path: path ending in .parquet, otherwise written as feather
+    :param meta_strings: list of meta lines
+    :param compression: pyarrow compression name. None uses the pyarrow default for the format.
+    """
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    metadata = dict(table.schema.metadata or {})
+    metadata[COLUMNAR_META_KEY] = json.dumps(list(meta_strings)).encode()
+    table = table.replace_schema_metadata(metadata)
+    compression_kwargs = {} if compression is None else {'compression': compression}
+    path = str(path)
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(table, path, **compression_kwargs)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, path, **compression_kwargs)
+
+
+def read_columnar_with_meta(path, memory_map=True):
+    """
+    Reads a file written by write_columnar_with_meta. Needs pyarrow.
+
+    :param path: path to a .parquet or .feather file
+    :param memory_map: memory map the file instead of reading it into a buffer first
+    :return: (df, meta_strings List[str])
+    """
+    path = str(path)
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, memory_map=memory_map)
+    else:
+        import pyarrow.feather as feather
+        table = feather.read_table(path, memory_map=memory_map)
+    metadata = table.schema.metadata or {}
+    meta_strings = json.loads(metadata.get(COLUMNAR_META_KEY, b'[]'))
+    return table.to_pandas(), meta_strings
+
+
 import os
 
 